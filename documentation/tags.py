@@ -24,6 +24,10 @@ tags_metadata = [
             "url": f"http://{public_ip}:8000/docs/scans",
         },
     },
+    {
+        "name": "monitoring",
+        "description": "Operational metrics, restricted to the admin token.",
+    },
     {
         "name": "docs",
         "description": "API documentation",
@@ -0,0 +1,104 @@
+# ------------------------------ PACKAGES ------------------------------
+# Standard imports
+import json
+from datetime import date
+
+# Third-party libraries
+from fastapi import (
+    Depends,
+    Query,
+    APIRouter,
+)
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Local imports
+import functions.audit as audit
+import functions.metrics as metrics
+import functions.utils as utils
+import endpoints.security as security
+from functions.fleet import manager as fleet
+
+# Database
+import postgres.crud as crud
+import postgres.schemas as schemas
+from postgres.database import get_db, pool_metrics
+
+################################## [ INIT ] ##################################
+
+router = APIRouter(prefix="/monitoring", tags=["monitoring"])
+
+################################### [ API ] ##################################
+# ------------------------------ Database ------------------------------
+
+
+# Connection pool usage
+@router.get(
+    "/database",
+    dependencies=[Depends(security.check_token)],
+)
+async def database_pool():
+    utils.api_log("Retrieving database pool metrics")
+    return pool_metrics()
+
+
+# ------------------------------ Metrics ------------------------------
+
+
+# Scan, fleet, upload and database metrics of this process, in the Prometheus text format
+@router.get(
+    "/metrics",
+    response_class=PlainTextResponse,
+    dependencies=[Depends(security.check_token)],
+)
+async def prometheus_metrics(db: AsyncSession = Depends(get_db)):
+    for status in ("queued", "running"):
+        metrics.queue_jobs.set(await crud.count_scan_jobs(db, status), status=status)
+    metrics.fleet_nodes.set(fleet.powered, state="powered")
+    metrics.fleet_nodes.set(fleet.needed(), state="leased")
+    pool = pool_metrics()
+    for state in ("size", "checked_out", "checked_in", "overflow"):
+        metrics.db_pool.set(pool[state], state=state)
+    metrics.db_pool_wait.set(pool["wait_seconds_max"])
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+# ------------------------------ Audit ------------------------------
+
+
+# Scanned assets and node IPs per scan, for a date range
+@router.get(
+    "/audit",
+    dependencies=[Depends(security.check_token)],
+)
+async def scan_audit(
+    start: date = Query(..., description="First day, YYYY-MM-DD"),
+    end: date = Query(None, description="Last day, YYYY-MM-DD. Defaults to start."),
+    legacy: bool = Query(False, description="Export in the former cert.json layout"),
+):
+    end = end or start
+    utils.api_log(f"Exporting scan audit from {start} to {end}")
+    if legacy:
+        return audit.export_legacy(start, end)
+    return StreamingResponse(
+        (json.dumps(record) + "\n" for record in audit.query(start, end)),
+        media_type="application/x-ndjson",
+    )
+
+
+# ------------------------------ Callbacks ------------------------------
+
+
+# Callbacks given up after their retries, most recent first
+@router.get(
+    "/callbacks",
+    response_model=list[schemas.CallbackFailure],
+    dependencies=[Depends(security.check_token)],
+)
+async def callback_failures(
+    db: AsyncSession = Depends(get_db),
+    skip: int = 0,
+    limit: int = 100,
+):
+    utils.api_log("Retrieving failed callbacks")
+    return await crud.get_callback_failures(db, skip, limit)
@@ -1,10 +1,16 @@
 # ------------------------------ PACKAGES ------------------------------
 # Standard imports
 import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from os import getenv, getpid, path, remove, replace
+from socket import gethostname
+from uuid import uuid4
 
 # Third-party libraries
 from fastapi import (
+    HTTPException,
     Query,
     File,
     UploadFile,
@@ -13,14 +19,21 @@ from fastapi import (
     APIRouter,
 )
 from fastapi.responses import JSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
 # Local imports
+import functions.metrics as metrics
 import functions.utils as utils
 import functions.scan as scan
+import functions.targets as targets
+import functions.workflow as workflow
 import endpoints.security as security
 
 # Database
+import postgres.crud as crud
 import postgres.models as models
+import postgres.schemas as schemas
+from postgres.database import SessionLocal, get_db
 
 
 ################################## [ INIT ] ##################################
@@ -29,31 +42,568 @@ profiles, formats, workflows = utils.load_json()
 ValidprofilesEnum = utils.create_enum("ValidprofilesEnum", profiles)
 ValidformatsEnum = utils.create_enum("ValidformatsEnum", formats)
 ValidworkflowsEnum = utils.create_enum("ValidworkflowsEnum", workflows)
+ValidstatusEnum = utils.create_enum(
+    "ValidstatusEnum", ["queued", "running", "completed", "error"]
+)
 
 router = APIRouter(prefix="/scans", tags=["scans"])
 
-scan_queue = asyncio.Queue()
+scan_workers, default_limit, profile_limits = utils.load_workers_config()
+lease_seconds = int(getenv("SCAN_LEASE_SECONDS", "300"))
+poll_interval = float(getenv("SCAN_POLL_INTERVAL", "5"))
+max_attempts = int(getenv("SCAN_MAX_ATTEMPTS", "3"))
+progress_interval = float(getenv("SCAN_PROGRESS_INTERVAL", "10"))
+upload_max_bytes = int(getenv("UPLOAD_MAX_BYTES", str(500 * 1024 * 1024)))
+upload_chunk_size = 1024 * 1024
+coalesce = utils.load_coalesce_config()
+quotas = utils.load_quotas_config()
+result_cache_ttl = int(getenv("RESULT_CACHE_TTL", "21600"))  # Seconds a result is reused, 0 disables the cache
+result_cache_purge_interval = float(getenv("RESULT_CACHE_PURGE_INTERVAL", "3600"))  # Seconds between two purges
+
+pool_condition = asyncio.Condition()
 
 ################################## [ FUNCTION ] ##################################
 
 
-async def process_queue():
-    """Continuously monitor the queue for new scan jobs."""
+def profile_limit(profile):
+    """Maximum number of concurrent scans allowed for a profile."""
+    return profile_limits.get(profile, default_limit)
+
+
+async def wake_workers():
+    """Wake up idle workers of this process, they will look for a job right away."""
+    async with pool_condition:
+        pool_condition.notify_all()
+
+
+async def wait_for_job():
+    """Sleep until a job is queued by this process or until the next database poll."""
+    async with pool_condition:
+        try:
+            await asyncio.wait_for(pool_condition.wait(), timeout=poll_interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def claim_job(worker_id):
+    """Lease the oldest queued job whose profile still has a free slot.
+
+    Jobs of a profile at its concurrency limit are left in the table, not blocked on,
+    so they never hold a worker while smaller jobs of other profiles are waiting.
+    Running jobs are counted in the database, the limits hold over every API process.
+    """
+    async with SessionLocal() as db:
+        return await crud.claim_scan_job(
+            db, worker_id, lease_seconds, max_attempts, profile_limits, default_limit, coalesce
+        )
+
+
+async def keep_lease(jobs, worker_id, progress, task):
+    """Renew the leases of running jobs so other processes do not take them over, and publish their progress.
+
+    A failed renewal is logged and retried at the next beat. A lease really lost (the
+    job expired and was claimed again) cancels `task`, the job must not run twice.
+    """
     while True:
-        job = await scan_queue.get()
-        await handle_scan(job)
-        scan_queue.task_done()
+        await asyncio.sleep(min(lease_seconds / 3, progress_interval))
+        try:
+            async with SessionLocal() as db:
+                for job in jobs:
+                    if not await crud.renew_scan_job_lease(
+                        db, job.id, worker_id, lease_seconds, progress
+                    ):
+                        utils.api_log(f"Worker {worker_id} lost the lease of job {job.id}, cancelling it")
+                        task.cancel()
+                        return
+        except Exception as e:
+            utils.api_log(f"DATABASE ERROR, worker {worker_id} could not renew its lease : {e}")
+
+
+async def run_leased(jobs, worker_id, progress, processing):
+    """Run the processing of leased jobs while their leases are renewed.
+
+    Returns:
+        The result of `processing`, None if a lease was lost and the processing cancelled
+    """
+    task = asyncio.create_task(processing)
+    heartbeat = asyncio.create_task(keep_lease(jobs, worker_id, progress, task))
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if not heartbeat.done():  # The worker itself is stopping
+            raise
+        return None
+    finally:
+        heartbeat.cancel()
+
+
+async def scan_worker(worker_id):
+    """Run queued scan jobs until the application stops."""
+    while True:
+        try:
+            job = await claim_job(worker_id)
+        except Exception as e:
+            utils.api_log(f"DATABASE ERROR, worker {worker_id} could not claim a job : {e}")
+            job = None
+        if job is None:
+            await wait_for_job()
+            continue
+        utils.api_log(
+            f"Worker {worker_id} picked job {job.id} ({job.profile} for {job.input}, attempt {job.attempts})"
+        )
+        try:
+            observe_queue_wait(job)
+            if job.workflow:
+                await handle_workflow(job, worker_id)
+            elif coalescable(job):
+                await handle_batch(job, worker_id)
+            else:
+                await handle_scan(job, worker_id)
+        except Exception as e:
+            # The job is taken over once its lease expires, the worker keeps running
+            utils.api_log(f"WORKER ERROR, worker {worker_id} failed on job {job.id} : {e}")
+        await wake_workers()
+
+
+async def queue_state():
+    """Number of queued and running jobs of every process, used to scale the Axiom fleet."""
+    async with SessionLocal() as db:
+        return await crud.count_scan_jobs(db, "queued"), await crud.count_scan_jobs(db, "running")
+
+
+async def process_queue():
+    """Start the scan worker pool and keep it running."""
+    utils.api_log(
+        f"Starting {scan_workers} scan workers (profile limits: {profile_limits}, default: {default_limit})"
+    )
+    process_id = f"{gethostname()}:{getpid()}"
+    await asyncio.gather(
+        *(scan_worker(f"{process_id}:{index}") for index in range(scan_workers))
+    )
+
+
+class ResultCache:
+    """Results of recent scans, reused for the same profile, format and targets.
+
+    A job whose whole target set was scanned less than RESULT_CACHE_TTL seconds ago
+    gets the existing S3 object without booting the fleet. When only some targets
+    were scanned, they are removed from the input and only the others are scanned.
+    """
+
+    def __init__(self, profile, format):
+        self.profile = profile
+        self.format = format
+        self.keys = []  # S3 keys of the cached results reused
+        self.complete = False  # Every target was cached
+        self.scanned = None  # Number of targets left to scan
+        self.hits = {}  # Cached target -> S3 key of its result
 
+    async def split(self, input_path, stats):
+        """Remove the cached targets from a prepared input file.
 
-async def handle_scan(job):
-    """Process each scan job one at a time."""
-    code = await scan.processing(
-        job["q"], job["domain"], job["output"], job["uuid"], job["client_ip"]
+        Returns:
+            int: Number of targets left to scan
+        """
+        self.scanned = stats["count"]
+        if result_cache_ttl <= 0:
+            return self.scanned
+        since = datetime.now() - timedelta(seconds=result_cache_ttl)
+        try:
+            async with SessionLocal() as db:
+                key = await crud.get_cached_result(
+                    db, self.profile, self.format, stats["digest"], since
+                )
+                if key is not None:
+                    self.keys, self.complete = [key], True
+                    return 0
+                remaining = 0
+                with open(f"{input_path}.uncached", "w", encoding="utf-8") as uncached:
+                    for chunk in targets.read_chunks(input_path):
+                        cached = await crud.get_cached_targets(
+                            db, self.profile, self.format, chunk, since
+                        )
+                        for target in chunk:
+                            if target in cached:
+                                self.hits[target] = cached[target]
+                                if cached[target] not in self.keys:
+                                    self.keys.append(cached[target])
+                            else:
+                                uncached.write(f"{target}\n")
+                                remaining += 1
+        except Exception as e:
+            utils.api_log(f"DATABASE ERROR, result cache lookup failed, scanning every target : {e}")
+            self.keys, self.hits = [], {}
+            return self.scanned
+        if self.keys:
+            replace(f"{input_path}.uncached", input_path)
+        else:
+            remove(f"{input_path}.uncached")
+        self.scanned = remaining
+        self.complete = remaining == 0
+        return remaining
+
+    async def store(self, input_path, stats, s3_key):
+        """Record the targets of a successful scan and the S3 object holding their results."""
+        if result_cache_ttl <= 0:
+            return
+        # The digest identifies the whole target set only if nothing was taken from the cache
+        digest = None if self.keys else stats["digest"]
+        try:
+            async with SessionLocal() as db:
+                db_result = await crud.create_scan_result(
+                    db, self.profile, self.format, digest, self.scanned, s3_key
+                )
+                for chunk in targets.read_chunks(input_path):
+                    await crud.add_scan_result_targets(db, db_result, chunk)
+        except Exception as e:
+            utils.api_log(f"DATABASE ERROR, result of {s3_key} not cached : {e}")
+
+
+async def purge_results():
+    """Delete the expired results of the cache every RESULT_CACHE_PURGE_INTERVAL seconds."""
+    while result_cache_ttl > 0:
+        try:
+            async with SessionLocal() as db:
+                purged = await crud.purge_scan_results(
+                    db, datetime.now() - timedelta(seconds=result_cache_ttl)
+                )
+            if purged:
+                utils.api_log(f"{purged} expired scan results purged from the result cache")
+        except Exception as e:
+            utils.api_log(f"DATABASE ERROR, expired scan results not purged : {e}")
+        await asyncio.sleep(result_cache_purge_interval)
+
+
+class ShardTracker:
+    """Status of the shards of a job, stored in the scan_shards table.
+
+    A failing database only loses the shard statuses, never the scan itself.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    async def plan(self, sizes):
+        """Store the shards of the job, returns the shards completed by a previous attempt."""
+        try:
+            async with SessionLocal() as db:
+                return await crud.plan_scan_shards(db, self.job_id, sizes)
+        except Exception as e:
+            utils.api_log(f"DATABASE ERROR, shards of job {self.job_id} not stored : {e}")
+            return []
+
+    async def update(self, shard, status, exit_code=None):
+        try:
+            async with SessionLocal() as db:
+                await crud.update_scan_shard(db, self.job_id, shard, status, exit_code)
+        except Exception as e:
+            utils.api_log(f"DATABASE ERROR, status of shard {shard} of job {self.job_id} not stored : {e}")
+
+
+class ProfileSlots:
+    """Concurrency slots of the profiles run by the stages of a workflow job.
+
+    A stage waits for a free slot of its profile, stored in the profile_slots table,
+    so workflows respect the per-profile limits of data/workers.json like single scans.
+    """
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+
+    @asynccontextmanager
+    async def hold(self, profile):
+        slot = None
+        while slot is None:
+            try:
+                async with SessionLocal() as db:
+                    slot = await crud.acquire_profile_slot(
+                        db, profile, self.worker_id, profile_limit(profile), lease_seconds
+                    )
+            except Exception as e:
+                utils.api_log(f"DATABASE ERROR, worker {self.worker_id} could not take a {profile} slot : {e}")
+            if slot is None:
+                await wait_for_job()
+        try:
+            yield
+        finally:
+            try:
+                async with SessionLocal() as db:
+                    await crud.release_profile_slot(db, slot.id)
+            except Exception as e:
+                # The slot expires once the lease of the job is no longer renewed
+                utils.api_log(f"DATABASE ERROR, {profile} slot {slot.id} not released : {e}")
+            await wake_workers()
+
+
+async def handle_scan(job, worker_id):
+    """Process a single scan job and store its final status."""
+    progress = {"targets": None, "lines": 0}
+    try:
+        result = await run_leased(
+            [job],
+            worker_id,
+            progress,
+            scan.processing(
+                job.profile,
+                job.input,
+                job.output,
+                job.uuid,
+                job.client_ip,
+                progress,
+                ResultCache(job.profile, job.output),
+                ShardTracker(job.id),
+            ),
+        )
+    except Exception as e:
+        utils.api_log(f"Scan for {job.input} failed with error: {e}")
+        result = {"status": "error", "exit_code": None, "s3_key": None, "cached_keys": []}
+    if result is None:
+        utils.api_log(f"Scan for {job.input} cancelled, job {job.id} is run by another worker")
+        return
+    await finish_job(job, worker_id, result)
+
+
+def coalescable(job):
+    """Whether a job has a single target that can be scanned together with others."""
+    return (
+        coalesce["window"] > 0
+        and job.target_count == 1
+        and job.profile in coalesce["profiles"]
+        and job.output in coalesce["formats"]
+    )
+
+
+async def handle_batch(job, worker_id):
+    """Scan a single-target job together with the queued jobs of the same profile and format.
+
+    The claim query holds such jobs back for the coalescing window, so the first worker
+    taking one after the window gets every job queued meanwhile in a single axiom run.
+    """
+    try:
+        async with SessionLocal() as db:
+            others = await crud.claim_scan_batch(db, job, lease_seconds, coalesce)
+    except Exception as e:
+        utils.api_log(f"DATABASE ERROR, worker {worker_id} could not coalesce job {job.id} : {e}")
+        others = []
+    if not others:
+        return await handle_scan(job, worker_id)
+    jobs = [job, *others]
+    for other in others:
+        observe_queue_wait(other)
+    utils.api_log(
+        f"Worker {worker_id} coalesced jobs {[batch_job.id for batch_job in jobs]} ({job.profile}, {job.output})"
     )
-    if code == "completed":
-        utils.api_log(f"Scan for {job['domain']} completed successfully.")
+    try:
+        results = await run_leased(
+            jobs,
+            worker_id,
+            None,
+            scan.processing_batch(
+                job.profile,
+                [
+                    {"input": batch_job.input, "uuid": batch_job.uuid, "client_ip": batch_job.client_ip}
+                    for batch_job in jobs
+                ],
+                job.output,
+                None,
+                ResultCache(job.profile, job.output),
+            ),
+        )
+    except Exception as e:
+        utils.api_log(f"Coalesced scan of jobs {[batch_job.id for batch_job in jobs]} failed with error: {e}")
+        results = None
+    if results is None:  # The jobs still leased are reported as failed
+        results = [
+            {"status": "error", "exit_code": None, "s3_key": None, "cached_keys": []} for batch_job in jobs
+        ]
+    for batch_job, result in zip(jobs, results):
+        input_path = f"/var/tmp/scan_input/{batch_job.input}"
+        # A job not stored is run again (or already by another worker), it needs its input
+        if await finish_job(batch_job, worker_id, result) and path.exists(input_path):
+            remove(input_path)
+
+
+async def handle_workflow(job, worker_id):
+    """Run the stages of a workflow job and store their results."""
+    progress = {"targets": None, "lines": 0}
+    try:
+        result = await run_leased(
+            [job],
+            worker_id,
+            progress,
+            workflow.processing(
+                job.workflow,
+                job.input,
+                job.output,
+                job.uuid,
+                job.client_ip,
+                progress,
+                ProfileSlots(worker_id),
+            ),
+        )
+    except Exception as e:
+        utils.api_log(f"Workflow {job.workflow} for {job.input} failed with error: {e}")
+        result = {"status": "error", "exit_code": None, "s3_key": None, "cached_keys": []}
+    if result is None:
+        utils.api_log(f"Workflow {job.workflow} for {job.input} cancelled, job {job.id} is run by another worker")
+        return
+    await finish_job(job, worker_id, result)
+
+
+def observe_queue_wait(job):
+    metrics.queue_wait.observe((job.started_at - job.created_at).total_seconds(), profile=job.profile)
+
+
+async def finish_job(job, worker_id, result):
+    """Store the final status of a job.
+
+    Returns:
+        bool: True if the status is stored, False if the lease was lost or the database failed
+    """
+    metrics.scans_finished.inc(profile=job.profile, status=result["status"])
+    if result["status"] == "completed":
+        utils.api_log(f"Scan for {job.input} completed successfully.")
     else:
-        utils.api_log(f"Scan for {job['domain']} failed.")
+        utils.api_log(f"Scan for {job.input} failed.")
+    try:
+        async with SessionLocal() as db:
+            return await crud.finish_scan_job(
+                db,
+                job.id,
+                worker_id,
+                result["status"],
+                result["exit_code"],
+                result["s3_key"],
+                result["cached_keys"],
+                result.get("stages"),
+            )
+    except Exception as e:
+        utils.api_log(f"DATABASE ERROR, status of job {job.id} not stored, it will be run again : {e}")
+        return False
+
+
+async def store_dead_letter(url, payload, attempts, error):
+    """Keep a callback given up by the dispatcher in the callback_failures table."""
+    try:
+        async with SessionLocal() as db:
+            await crud.create_callback_failure(db, url, payload, attempts, error)
+    except Exception as e:
+        utils.api_log(f"DATABASE ERROR, failed callback to {url} for {payload} lost : {e}")
+
+
+class CallbackStore:
+    """Pending callbacks of this process, stored in the pending_callbacks table.
+
+    A failing database only loses the durability of a callback, never the callback itself.
+    """
+
+    def __init__(self, owner):
+        self.owner = owner
+
+    async def add(self, url, payload, lease_seconds):
+        """Store a new callback, returns its id (None if it is not stored)."""
+        try:
+            async with SessionLocal() as db:
+                return (await crud.create_pending_callback(db, url, payload, self.owner, lease_seconds)).id
+        except Exception as e:
+            utils.api_log(f"DATABASE ERROR, callback to {url} for {payload} not stored : {e}")
+            return None
+
+    async def claim(self, lease_seconds, limit):
+        """Take over the callbacks whose leases expired, as (id, url, payload, attempt, due_at)."""
+        try:
+            async with SessionLocal() as db:
+                return [
+                    (c.id, c.url, c.payload, c.attempt, c.due_at)
+                    for c in await crud.claim_pending_callbacks(db, self.owner, lease_seconds, limit)
+                ]
+        except Exception as e:
+            utils.api_log(f"DATABASE ERROR, pending callbacks not taken over : {e}")
+            return []
+
+    async def renew(self, lease_seconds):
+        try:
+            async with SessionLocal() as db:
+                await crud.renew_pending_callbacks(db, self.owner, lease_seconds)
+        except Exception as e:
+            utils.api_log(f"DATABASE ERROR, leases of the pending callbacks not renewed : {e}")
+
+    async def reschedule(self, callback_id, attempt, due_at):
+        try:
+            async with SessionLocal() as db:
+                await crud.reschedule_pending_callback(db, callback_id, attempt, due_at)
+        except Exception as e:
+            utils.api_log(f"DATABASE ERROR, retry of pending callback {callback_id} not stored : {e}")
+
+    async def remove(self, callback_id):
+        try:
+            async with SessionLocal() as db:
+                await crud.delete_pending_callback(db, callback_id)
+        except Exception as e:
+            # Sent again once taken over, callbacks are delivered at least once
+            utils.api_log(f"DATABASE ERROR, pending callback {callback_id} not removed : {e}")
+
+
+def job_priority(target_count):
+    """Priority class of a job: 0 interactive (a few targets), 1 bulk."""
+    return 0 if target_count <= quotas["interactive_max_targets"] else 1
+
+
+async def check_quota(db, email, target_count=0):
+    """Refuse a job that would exceed the quotas of a user (data/quotas.json) with a 429."""
+    user_quotas = {**quotas["default"], **quotas["users"].get(email, {})}
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    active, targets_today = await crud.get_scan_usage(db, email, today)
+    concurrent_jobs = user_quotas.get("concurrent_jobs")
+    if concurrent_jobs is not None and active >= concurrent_jobs:
+        utils.api_log(f"QUOTA, {email} already has {active} queued or running jobs")
+        raise HTTPException(
+            status_code=429,
+            detail=f"Too many scans in progress (limit {concurrent_jobs}), retry when one is finished",
+        )
+    targets_per_day = user_quotas.get("targets_per_day")
+    if targets_per_day is not None and targets_today + target_count > targets_per_day:
+        utils.api_log(f"QUOTA, {email} exceeds {targets_per_day} targets today")
+        raise HTTPException(
+            status_code=429,
+            detail=f"Daily target quota exceeded ({targets_today} of {targets_per_day} used)",
+            headers={"Retry-After": str(int((today + timedelta(days=1) - datetime.now()).total_seconds()))},
+        )
+
+
+async def save_upload(upload, file_path):
+    """Stream an uploaded target file to disk, normalising and deduplicating targets on the way.
+
+    Raises:
+        HTTPException: 413 above UPLOAD_MAX_BYTES, 400 if the file has no target
+
+    Returns:
+        int: Number of distinct targets saved
+    """
+    writer = targets.TargetWriter(file_path, csv=(upload.filename or "").endswith(".csv"))
+    size = 0
+    try:
+        while chunk := await upload.read(upload_chunk_size):
+            size += len(chunk)
+            if size > upload_max_bytes:
+                utils.api_log(f"UPLOAD ERROR, {upload.filename} is larger than {upload_max_bytes} bytes")
+                raise HTTPException(status_code=413, detail="Uploaded file is too large")
+            await asyncio.to_thread(writer.feed, chunk)
+    except Exception:
+        writer.close()
+        remove(file_path)
+        raise
+    count = writer.close()
+    if count == 0:
+        remove(file_path)
+        raise HTTPException(status_code=400, detail="No target found in the uploaded file")
+    utils.api_log(f"{count} distinct targets saved in {file_path}")
+    return count
+
+
+def job_status(job, position):
+    """Build the API representation of a job."""
+    return schemas.ScanJob(**utils.to_dict(job), queue_position=position)
 
 
 ################################### [ API ] ##################################
@@ -64,6 +614,7 @@ async def handle_scan(job):
 @router.get("/")
 async def single_scan(
     request: Request,
+    db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(security.get_current_user),
     q: ValidprofilesEnum = Query(..., description="Must be one of the valid values."),
     domain: str = Query(..., min_length=1, description="Cannot be empty"),
@@ -79,33 +630,39 @@ async def single_scan(
     utils.api_log(
         f"Single scan requested by {current_user.email} (IP : {request.client.host}). Domain is {domain} and case is {q.value}"
     )
-    filename = f"{domain}.txt"
+    await check_quota(db, current_user.email, 1)
+    # Unique per job, concurrent scans of the same domain must not share their input
+    filename = f"{targets.safe_filename(f'{domain}.txt')}_{uuid4().hex[:8]}.txt"
     with open(
         f"/var/tmp/scan_input/{filename}", "w", encoding="utf-8"
     ) as f:  # Save single input as file in input folder
         f.write(f"{domain}\n")
     utils.api_log(f"Temporary file saved as /var/tmp/scan_input/{filename}")
 
-    request_data = {
-        "domain": filename,
-        "q": q,
-        "output": output,
-        "uuid": uuid,
-        "client_ip": request.client.host,
-    }
-
-    # Append the job to the in-memory queue
-    await scan_queue.put(request_data)
-    utils.api_log("Job sent to queue")
+    # Store the job in the durable queue
+    job = await crud.create_scan_job(
+        db,
+        q.value,
+        filename,
+        output,
+        uuid,
+        request.client.host,
+        current_user.email,
+        1,
+        job_priority(1),
+    )
+    await wake_workers()
+    utils.api_log(f"Job {job.id} sent to queue")
 
     # Return immediately to the requester
-    return JSONResponse({"message": "Job sent to queue"})
+    return JSONResponse({"message": "Job sent to queue", "job_id": job.id})
 
 
 # API endpoint for file scan
 @router.post("/")
 async def file_scan(
     request: Request,
+    db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(security.get_current_user),
     q: ValidprofilesEnum = Query(..., description="Must be one of the valid values."),
     domain: UploadFile = File(...),
@@ -118,21 +675,157 @@ async def file_scan(
         output = "txt"
     else:
         output = output.value
-    contents = await domain.read()  # Wait & Read uploaded file
+    await check_quota(db, current_user.email)
+    filename = f"{targets.safe_filename(domain.filename)}_{uuid4().hex[:8]}.txt"
+    file_path = f"/var/tmp/scan_input/{filename}"
     utils.api_log(
-        f"File scan requested by {current_user.email} (IP : {request.client.host}). File is here /var/tmp/scan_input/{domain.filename} and case is {q.value}"
+        f"File scan requested by {current_user.email} (IP : {request.client.host}). File is here {file_path} and case is {q.value}"
     )
-    with open(f"/var/tmp/scan_input/{domain.filename}", "wb") as f:
-        f.write(contents)
-    request_data = {
-        'domain': domain.filename,
-        'q': q,
-        'output': output,
-        'uuid': uuid,
-        'client_ip': request.client.host
-    }
-    await scan_queue.put(request_data)
-    utils.api_log("Job sent to queue")
+    count = await save_upload(domain, file_path)
+    try:
+        await check_quota(db, current_user.email, count)
+    except HTTPException:
+        remove(file_path)
+        raise
+    job = await crud.create_scan_job(
+        db,
+        q.value,
+        filename,
+        output,
+        uuid,
+        request.client.host,
+        current_user.email,
+        count,
+        job_priority(count),
+    )
+    await wake_workers()
+    utils.api_log(f"Job {job.id} sent to queue")
 
     # Return immediately to the requester
-    return JSONResponse({"message": "Job sent to queue"})
+    return JSONResponse({"message": "Job sent to queue", "job_id": job.id})
+
+
+# API endpoint for a workflow on a single domain
+@router.get("/workflow")
+async def single_workflow(
+    request: Request,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(security.get_current_user),
+    w: ValidworkflowsEnum = Query(..., description="Must be one of the valid values."),
+    domain: str = Query(..., min_length=1, description="Cannot be empty"),
+    output: ValidformatsEnum = Query(
+        None, description="Optional format of the last stages. Must be one of the valid values."
+    ),
+    uuid: str = Query(None, min_length=1, description="Optional to notify end of workflow"),
+):
+    output = "txt" if output is None else output.value
+    utils.api_log(
+        f"Workflow {w.value} requested by {current_user.email} (IP : {request.client.host}). Domain is {domain}"
+    )
+    await check_quota(db, current_user.email, 1)
+    filename = f"{targets.safe_filename(f'{domain}.txt')}_{uuid4().hex[:8]}.txt"
+    with open(f"/var/tmp/scan_input/{filename}", "w", encoding="utf-8") as f:
+        f.write(f"{domain}\n")
+    job = await crud.create_scan_job(
+        db,
+        w.value,
+        filename,
+        output,
+        uuid,
+        request.client.host,
+        current_user.email,
+        1,
+        job_priority(1),
+        w.value,
+    )
+    await wake_workers()
+    utils.api_log(f"Workflow job {job.id} sent to queue")
+    return JSONResponse({"message": "Workflow sent to queue", "job_id": job.id})
+
+
+# API endpoint for a workflow on a file
+@router.post("/workflow")
+async def file_workflow(
+    request: Request,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(security.get_current_user),
+    w: ValidworkflowsEnum = Query(..., description="Must be one of the valid values."),
+    domain: UploadFile = File(...),
+    output: ValidformatsEnum = Query(
+        None, description="Optional format of the last stages. Must be one of the valid values."
+    ),
+    uuid: str = Query(None, min_length=1, description="Optional to notify end of workflow"),
+):
+    output = "txt" if output is None else output.value
+    await check_quota(db, current_user.email)
+    filename = f"{targets.safe_filename(domain.filename)}_{uuid4().hex[:8]}.txt"
+    file_path = f"/var/tmp/scan_input/{filename}"
+    utils.api_log(
+        f"Workflow {w.value} requested by {current_user.email} (IP : {request.client.host}). File is here {file_path}"
+    )
+    count = await save_upload(domain, file_path)
+    try:
+        await check_quota(db, current_user.email, count)
+    except HTTPException:
+        remove(file_path)
+        raise
+    job = await crud.create_scan_job(
+        db,
+        w.value,
+        filename,
+        output,
+        uuid,
+        request.client.host,
+        current_user.email,
+        count,
+        job_priority(count),
+        w.value,
+    )
+    await wake_workers()
+    utils.api_log(f"Workflow job {job.id} sent to queue")
+    return JSONResponse({"message": "Workflow sent to queue", "job_id": job.id})
+
+
+# ------------------------------ Scan Status ------------------------------
+
+
+# List the jobs of the current user
+@router.get("/jobs", response_model=list[schemas.ScanJob])
+async def list_jobs(
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(security.get_current_user),
+    status: ValidstatusEnum = Query(None, description="Optional status filter."),
+    skip: int = 0,
+    limit: int = 100,
+):
+    jobs = await crud.get_scan_jobs(
+        db, current_user.email, status.value if status else None, skip, limit
+    )
+    return [job_status(job, position) for job, position in jobs]
+
+
+# Retrieve the status and result of a job
+@router.get("/{job_id}", response_model=schemas.ScanJob)
+async def get_job(
+    job_id: int,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(security.get_current_user),
+):
+    row = await crud.get_scan_job(db, job_id)
+    if row is None or row[0].owner != current_user.email:
+        raise HTTPException(status_code=404, detail="Job not found")
+    job, position = row
+    return job_status(job, position)
+
+
+# Retrieve the status of each shard of a job
+@router.get("/{job_id}/shards", response_model=list[schemas.ScanShard])
+async def get_job_shards(
+    job_id: int,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(security.get_current_user),
+):
+    row = await crud.get_scan_job(db, job_id)
+    if row is None or row[0].owner != current_user.email:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return await crud.get_scan_shards(db, job_id)
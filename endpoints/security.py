@@ -1,8 +1,12 @@
 # ------------------------------ PACKAGES ------------------------------
 # Standard imports
+import asyncio
+import json
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from os import getenv
+from random import random
+from time import monotonic, perf_counter
 from pydantic import BaseModel
 from typing import Union
 import re
@@ -11,19 +15,21 @@ import re
 from botocore.exceptions import NoCredentialsError, PartialCredentialsError
 from fastapi import HTTPException, Depends, status, Request
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from passlib.context import CryptContext
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+import asyncpg
 import boto3
 import jwt
 
 # Local imports
+import functions.logger as logger
 import functions.utils as utils
+from functions.passwords import verify_password
 from src.app import app
 
 # Database
 import postgres.crud as crud
-from postgres.database import get_db
+from postgres.database import engine, get_db
 
 
 # ------------------------------ GENERAL ------------------------------
@@ -43,20 +49,23 @@ class TokenData(BaseModel):
     email: Union[str, None] = None
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
 
+# Admin token cache
+SECRET_TTL = float(getenv("SECRET_TTL", "300"))
+SECRET_MIN_REFRESH = float(getenv("SECRET_MIN_REFRESH", "30"))
+secrets_client = None
+secret_cache = {"value": None, "fetched_at": 0.0}
+secret_lock = asyncio.Lock()
 
-# ------------------------------ TOKEN ------------------------------
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
+access_log_config = utils.load_access_log_config()
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+# User cache invalidation
+USER_LISTEN_PING = 30  # Seconds between two checks of the listening connection
+USER_LISTEN_RETRY = 5  # Seconds before a lost listening connection is opened again
 
 
+# ------------------------------ TOKEN ------------------------------
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
     if expires_delta:
@@ -69,23 +78,34 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
 
 
 # Functions to check admin token
-def check_token(token: str = Depends(oauth2_scheme)):
-    stored_token = get_secret()
-    if token != stored_token:
-        utils.api_log("ADMIN TOKEN ERROR, invalid token provided\n\n")
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid authentication credentials",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
+async def check_token(request: Request, token: str = Depends(oauth2_scheme)):
+    if token != await get_secret():
+        # The secret may have been rotated since it was cached
+        if token != await get_secret(force=True):
+            utils.api_log("ADMIN TOKEN ERROR, invalid token provided\n\n")
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Invalid authentication credentials",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+    request.state.user = "admin"
     return
 
 
-def get_secret():
+def get_secrets_client():
+    """Reuse a single Secrets Manager client, creating a session is expensive."""
+    global secrets_client
+    if secrets_client is None:
+        session = boto3.session.Session()
+        secrets_client = session.client(
+            service_name="secretsmanager", region_name=getenv("REGION_NAME")
+        )
+    return secrets_client
+
+
+def fetch_secret():
     secret_name = getenv("SECRET_NAME")
-    region_name = getenv("REGION_NAME")
-    session = boto3.session.Session()
-    client = session.client(service_name="secretsmanager", region_name=region_name)
+    client = get_secrets_client()
     try:
         get_secret_value_response = client.get_secret_value(SecretId=secret_name)
     except (NoCredentialsError, PartialCredentialsError):
@@ -99,13 +119,53 @@ def get_secret():
     return secret
 
 
+async def get_secret(force: bool = False):
+    """Return the admin token, from the in-process cache when it is fresh
+
+    Args:
+        force (bool, optional): Fetch the secret again even if the cache is fresh. A forced
+            refresh happens at most once every SECRET_MIN_REFRESH seconds. Defaults to False.
+
+    Returns:
+        str: The admin token
+    """
+    age = monotonic() - secret_cache["fetched_at"]
+    if secret_cache["value"] is not None:
+        if age < (SECRET_MIN_REFRESH if force else SECRET_TTL):
+            return secret_cache["value"]
+    fetched_at = secret_cache["fetched_at"]
+    async with secret_lock:
+        if secret_cache["fetched_at"] != fetched_at:  # Refreshed while waiting for the lock
+            return secret_cache["value"]
+        try:
+            secret = await asyncio.to_thread(fetch_secret)
+        except Exception:
+            if secret_cache["value"] is None:
+                raise
+            utils.api_log("TOKEN ERROR, keeping the cached secret until AWS answers again")
+            return secret_cache["value"]
+        secret_cache["value"] = secret
+        secret_cache["fetched_at"] = monotonic()
+    return secret
+
+
+async def refresh_secret():
+    """Refresh the cached secret in the background so requests never wait for AWS."""
+    while True:
+        try:
+            await get_secret(force=True)
+        except Exception as e:
+            utils.api_log(f"TOKEN ERROR, background refresh failed : {e}")
+        await asyncio.sleep(SECRET_TTL / 2)
+
+
 # ------------------------------ USER ------------------------------
 async def get_user(db: Session, email: str):
-    return await crud.get_user_by_email(db, email)
+    return await crud.get_cached_user_by_email(db, email)
 
 
 async def get_current_user(
-    db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)
+    request: Request, db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)
 ):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -117,7 +177,7 @@ async def get_current_user(
         detail="This token does not have the right to perform scans",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    stored_token = get_secret()
+    stored_token = await get_secret()
     if token == stored_token:
         raise token_exception
     payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
@@ -130,12 +190,45 @@ async def get_current_user(
     if user is None:
         utils.api_log("AUTH ERROR, wrong admin token usage\n\n")
         raise credentials_exception
+    request.state.user = user.email
+    if user.disabled:
+        utils.api_log(f"AUTH ERROR, disabled user {user.email}\n\n")
+        raise credentials_exception
     return user
 
 
+async def watch_user_changes():
+    """Drop the users changed by any API process from the user cache.
+
+    The crud functions changing a user send a NOTIFY on crud.USER_CHANNEL, listened
+    to on a connection of its own. Notifications sent while it is down are lost, so
+    the whole cache is cleared every time it is opened again; meanwhile a cached user
+    is served for USER_CACHE_TTL seconds at most.
+    """
+
+    def on_change(connection, pid, channel, email):
+        crud.user_cache.invalidate(email)
+
+    dsn = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+    while True:
+        try:
+            connection = await asyncpg.connect(dsn)
+            try:
+                await connection.add_listener(crud.USER_CHANNEL, on_change)
+                crud.user_cache.clear()
+                while True:
+                    await asyncio.sleep(USER_LISTEN_PING)
+                    await connection.execute("SELECT 1")
+            finally:
+                await connection.close(timeout=USER_LISTEN_RETRY)
+        except Exception as e:
+            utils.api_log(f"DATABASE ERROR, user cache invalidation stopped, retrying : {e}")
+        await asyncio.sleep(USER_LISTEN_RETRY)
+
+
 async def authenticate_user(db: Session, email: str, password: str):
     user = await crud.get_user_by_email(db, email)
-    if not user or not verify_password(password, user.hashed_password):
+    if not user or not await verify_password(password, user.hashed_password):
         return None
     return user
 
@@ -174,17 +267,54 @@ async def login_for_access_token(
 
 
 # ------------------------------ MONITORING ------------------------------
+def access_log_sampled(route: str, status_code: int):
+    """Decide whether a request goes to the access log. Errors (auth failures included) are always logged."""
+    if status_code >= access_log_config.get("always_log_from_status", 400):
+        return True
+    rate = access_log_config["routes"].get(route, access_log_config.get("default_rate", 1.0))
+    return rate >= 1 or random() < rate
+
+
+def request_route(request: Request):
+    """Route of a request as configured in data/access_log.json.
+
+    A mount (the static files of the documentation) sets no route, it extends the
+    root_path of the scope by its own path instead.
+    """
+    route = request.scope.get("route")
+    if route is not None:
+        return route.path
+    if "app_root_path" in request.scope:  # Only set once a mount matched
+        return request.scope["root_path"][len(request.scope["app_root_path"]):]
+    return request.url.path
+
+
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    # Log request details
-    client_ip = request.client.host
-    url = str(request.url)
-    method = request.method
-    headers = dict(request.headers)
-
-    utils.api_log(
-        f"MONITORING - IP: {client_ip}, URL: {url}, Method: {method}, Headers: {headers}"
-    )
-    response = await call_next(request)
+    start = perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        route = request_route(request)
+        if access_log_sampled(route, status_code):
+            redacted = access_log_config["redact_headers"]
+            record = {
+                "time": datetime.now().isoformat(timespec="milliseconds"),
+                "ip": request.client.host if request.client else None,
+                "method": request.method,
+                "route": route,
+                "path": request.url.path,
+                "query": request.url.query,
+                "status": status_code,
+                "latency_ms": round((perf_counter() - start) * 1000, 2),
+                "user": getattr(request.state, "user", None),
+                "headers": {
+                    key: "[REDACTED]" if key in redacted else value
+                    for key, value in request.headers.items()
+                },
+            }
+            logger.write_line("access", json.dumps(record))
 
     return response
@@ -120,7 +120,7 @@ async def activate_user(
             f"DATABASE ERROR, user {user_email} not found, impossible to activate\n\n"
         )
         raise HTTPException(status_code=404, detail="User not found")
-    user = await crud.activate_user(db=db, email=user_email, user=user)
+    user = await crud.activate_user(db=db, email=user_email)
     utils.api_log(f"User {user_email} activated \n\n")
     return utils.clean_user_data(user)
 
@@ -140,7 +140,7 @@ async def deactivate_user(
             f"DATABASE ERROR, user {user_email} not found, impossible to deactivate\n\n"
         )
         raise HTTPException(status_code=404, detail="User not found")
-    user = await crud.deactivate_user(db=db, email=user_email, user=user)
+    user = await crud.deactivate_user(db=db, email=user_email)
     utils.api_log(f"User {user_email} deactivated \n\n")
     return utils.clean_user_data(user)
 
@@ -0,0 +1,124 @@
+# ------------------------------ PACKAGES ------------------------------
+# Standard imports
+import asyncio
+import fcntl
+import json
+from datetime import date, datetime, timedelta
+from os import makedirs, path, rename
+
+# Local imports
+from functions.logger import LOG_DIR
+
+
+# ------------------------------ INIT ------------------------------
+AUDIT_DIR = path.join(LOG_DIR, "cert")  # One append-only JSON lines segment per day
+LEGACY_FILE = path.join(LOG_DIR, "cert.json")
+
+
+# ------------------------------ WRITE ------------------------------
+def segment(day: date):
+    return path.join(AUDIT_DIR, f"{day.isoformat()}.jsonl")
+
+
+def append(records: list):
+    """Append records to the segment of their day.
+
+    Each segment is locked while writing, so workers of several processes can
+    record scans at the same time without interleaving lines.
+    """
+    makedirs(AUDIT_DIR, exist_ok=True)
+    for record in records:
+        line = json.dumps(record) + "\n"
+        with open(segment(date.fromisoformat(record["date"])), "a", encoding="utf-8") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                file.write(line)
+            finally:
+                file.flush()
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def append_scan(record: dict, assets_path: str):
+    """Append a scan record, its assets are streamed from a file so they are never all in memory."""
+    makedirs(AUDIT_DIR, exist_ok=True)
+    head = json.dumps(record)[:-1]  # Reopen the object to add the assets list last
+    with open(segment(date.fromisoformat(record["date"])), "a", encoding="utf-8") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            file.write(f'{head}, "assets": [')
+            with open(assets_path, encoding="utf-8") as assets:
+                separator = ""
+                for line in assets:
+                    if line.strip():
+                        file.write(separator + json.dumps(line.strip()))
+                        separator = ", "
+            file.write("]}\n")
+        finally:
+            file.flush()
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+async def record_scan(assets_path: str, ip: list, command: str, start: datetime, end: datetime):
+    """Record which assets were scanned, from which node IPs and with which command."""
+    record = {
+        "date": start.strftime("%Y-%m-%d"),
+        "time_range": f"{start.strftime('%H:%M:%S')} - {end.strftime('%H:%M:%S')}",
+        "start": start.isoformat(timespec="seconds"),
+        "end": end.isoformat(timespec="seconds"),
+        "ip": ip,
+        "command": command,
+    }
+    await asyncio.to_thread(append_scan, record, assets_path)
+
+
+# ------------------------------ READ ------------------------------
+def query(start: date, end: date):
+    """Yield the records of every day between start and end (included), oldest first."""
+    day = start
+    while day <= end:
+        if path.exists(segment(day)):
+            with open(segment(day), encoding="utf-8") as file:
+                for line in file:
+                    if line.strip():
+                        yield json.loads(line)
+        day += timedelta(days=1)
+
+
+def export_legacy(start: date, end: date):
+    """Rebuild the former cert.json layout {date: {time_range: {assets, ip, command}}}.
+
+    Scans sharing a time range used to overwrite each other, they get a " #n" suffix instead.
+    """
+    data = {}
+    for record in query(start, end):
+        scans = data.setdefault(record["date"], {})
+        key = record["time_range"]
+        suffix = 2
+        while key in scans:
+            key = f"{record['time_range']} #{suffix}"
+            suffix += 1
+        scans[key] = {"assets": record["assets"], "ip": record["ip"], "command": record["command"]}
+    return data
+
+
+def migrate_legacy():
+    """Move the entries of a former cert.json into the daily segments, once.
+
+    The file is claimed by renaming it first: every API process runs the migration
+    at startup, only the one whose rename succeeds migrates it.
+    """
+    claimed = f"{LEGACY_FILE}.migrating"
+    try:
+        rename(LEGACY_FILE, claimed)
+    except FileNotFoundError:  # No former file, or claimed by another process
+        return 0
+    with open(claimed, encoding="utf-8") as file:
+        legacy = json.load(file)
+    records = [
+        {"date": day, "time_range": time_range, **scan}
+        for day, scans in legacy.items()
+        for time_range, scan in scans.items()
+    ]
+    append(records)
+    rename(claimed, f"{LEGACY_FILE}.migrated")
+    return len(records)
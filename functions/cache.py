@@ -0,0 +1,39 @@
+# ------------------------------ PACKAGES ------------------------------
+# Standard imports
+from collections import OrderedDict
+from time import monotonic
+
+
+# ------------------------------ CACHE ------------------------------
+class TTLCache:
+    """Bounded in-process cache, least recently used entries are evicted first
+    and entries expire `ttl` seconds after they were stored."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expiry, value)
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        expiry, value = entry
+        if expiry < monotonic():
+            del self.entries[key]
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.entries[key] = (monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,176 @@
+# ------------------------------ PACKAGES ------------------------------
+# Standard imports
+import asyncio
+import hashlib
+import hmac
+import json
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from os import getenv
+from random import random
+from time import time
+
+# Third-party libraries
+import httpx
+
+# Local imports
+import functions.utils as utils
+
+
+# ------------------------------ INIT ------------------------------
+load_dotenv()
+CALLBACK_URL = getenv("CALLBACK_URL", "http://{client_ip}/callback")  # {client_ip} is the requester address
+CALLBACK_WORKERS = int(getenv("CALLBACK_WORKERS", "4"))  # Callbacks sent at once
+CALLBACK_TIMEOUT = float(getenv("CALLBACK_TIMEOUT", "10"))  # Seconds per request
+CALLBACK_ATTEMPTS = int(getenv("CALLBACK_ATTEMPTS", "5"))
+CALLBACK_RETRY_DELAY = float(getenv("CALLBACK_RETRY_DELAY", "2"))  # Seconds, doubled after every failed attempt
+CALLBACK_RETRY_MAX_DELAY = float(getenv("CALLBACK_RETRY_MAX_DELAY", "300"))
+CALLBACK_LEASE_SECONDS = int(getenv("CALLBACK_LEASE_SECONDS", "60"))  # Pending callbacks of a stopped process are taken over after it
+CALLBACK_CLAIM_BATCH = 100  # Pending callbacks taken over at once
+RETRIED_STATUSES = {408, 425, 429}  # Client errors worth retrying, every 5xx is retried too
+
+
+# ------------------------------ DISPATCHER ------------------------------
+class CallbackDispatcher:
+    """Send the end of scan callbacks without ever blocking a scan.
+
+    Callbacks are queued and sent by a few worker tasks through a single pooled HTTP
+    client. Failed deliveries are retried with exponential backoff; a callback still
+    failing after CALLBACK_ATTEMPTS tries, or refused by the client, is handed to the
+    dead letter handler. With CALLBACK_SECRET set, every body is signed with HMAC-SHA256.
+
+    With a store, every callback is kept in the pending_callbacks table until it is
+    sent or given up, leased to this process. The leases are renewed every third of
+    CALLBACK_LEASE_SECONDS; the callbacks of a process which stopped are taken over
+    once their leases expire, so a restart delays them instead of losing them.
+    """
+
+    def __init__(self, workers: int, client: httpx.AsyncClient = None, secret: str = None):
+        self.workers = workers
+        self.client = client
+        self.secret = secret
+        self.queue = asyncio.Queue()  # (pending callback id, url, payload, attempt)
+        self.dead_letter = None
+        self.store = None
+        self.storing = set()  # Tasks storing new callbacks, referenced until done
+
+    def get_client(self):
+        """Reuse a single HTTP client, its connections are kept alive between callbacks."""
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(CALLBACK_TIMEOUT),
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            )
+        return self.client
+
+    def sign(self, timestamp: str, body: bytes):
+        """HMAC-SHA256 of "{timestamp}.{body}", the timestamp lets clients reject replays."""
+        message = timestamp.encode() + b"." + body
+        return hmac.new(self.secret.encode(), message, hashlib.sha256).hexdigest()
+
+    def send(self, url: str, payload: dict):
+        """Queue a callback, returns immediately."""
+        if self.store is None:
+            self.queue.put_nowait((None, url, payload, 1))
+            return
+        task = asyncio.create_task(self.keep(url, payload))
+        self.storing.add(task)
+        task.add_done_callback(self.storing.discard)
+
+    async def keep(self, url: str, payload: dict):
+        """Store a new callback before queueing it, it is still sent if the database fails."""
+        callback_id = await self.store.add(url, payload, CALLBACK_LEASE_SECONDS)
+        self.queue.put_nowait((callback_id, url, payload, 1))
+
+    async def deliver(self, url: str, payload: dict):
+        """POST a callback once.
+
+        Returns:
+            tuple: (error, retry), error is None if the callback was accepted
+        """
+        body = json.dumps(payload, separators=(",", ":")).encode()
+        headers = {"Content-Type": "application/json"}
+        if self.secret:
+            timestamp = str(int(time()))
+            headers["X-Signature-Timestamp"] = timestamp
+            headers["X-Signature"] = f"sha256={self.sign(timestamp, body)}"
+        try:
+            response = await self.get_client().post(url, content=body, headers=headers)
+        except httpx.HTTPError as e:
+            return f"{type(e).__name__}: {e}", True
+        if response.is_success:
+            return None, False
+        retry = response.status_code >= 500 or response.status_code in RETRIED_STATUSES
+        return f"HTTP {response.status_code}", retry
+
+    async def attempt(self, callback_id: int, url: str, payload: dict, attempt: int):
+        error, retry = await self.deliver(url, payload)
+        if error is None:
+            utils.api_log(f"Callback sent to {url} for {payload.get('uuid')}")
+            await self.forget(callback_id)
+            return
+        if not retry or attempt >= CALLBACK_ATTEMPTS:
+            utils.api_log(f"Failed to notify {url} after {attempt} attempts, error: {error}")
+            if self.dead_letter is not None:
+                await self.dead_letter(url, payload, attempt, error)
+            await self.forget(callback_id)
+            return
+        delay = min(CALLBACK_RETRY_MAX_DELAY, CALLBACK_RETRY_DELAY * 2 ** (attempt - 1))
+        delay *= 0.5 + random() / 2
+        utils.api_log(f"Failed to notify {url} (attempt {attempt}), error: {error}, retrying in {delay:.1f}s")
+        if self.store is not None and callback_id is not None:
+            await self.store.reschedule(callback_id, attempt + 1, datetime.now() + timedelta(seconds=delay))
+        self.schedule(delay, (callback_id, url, payload, attempt + 1))
+
+    def schedule(self, delay: float, item: tuple):
+        """Queue a callback in `delay` seconds, the workers are free for other callbacks meanwhile."""
+        asyncio.get_running_loop().call_later(max(delay, 0), self.queue.put_nowait, item)
+
+    async def forget(self, callback_id: int):
+        """Remove a callback sent or given up from the store."""
+        if self.store is not None and callback_id is not None:
+            await self.store.remove(callback_id)
+
+    async def recover(self):
+        """Renew the leases of the pending callbacks of this process and take over those of stopped processes."""
+        while True:
+            await self.store.renew(CALLBACK_LEASE_SECONDS)
+            for callback_id, url, payload, attempt, due_at in await self.store.claim(
+                CALLBACK_LEASE_SECONDS, CALLBACK_CLAIM_BATCH
+            ):
+                utils.api_log(f"Callback to {url} for {payload.get('uuid')} taken over (attempt {attempt})")
+                self.schedule((due_at - datetime.now()).total_seconds(), (callback_id, url, payload, attempt))
+            await asyncio.sleep(CALLBACK_LEASE_SECONDS / 3)
+
+    async def worker(self):
+        while True:
+            callback_id, url, payload, attempt = await self.queue.get()
+            try:
+                await self.attempt(callback_id, url, payload, attempt)
+            except Exception as e:
+                utils.api_log(f"CALLBACK ERROR, callback to {url} dropped : {e}")
+            finally:
+                self.queue.task_done()
+
+    async def run(self, dead_letter=None, store=None):
+        """Send queued callbacks until the application stops.
+
+        Args:
+            dead_letter (Callable, optional): Coroutine called with (url, payload, attempts, error)
+                for every callback given up. Defaults to None.
+            store (optional): Pending callbacks table (add, claim, renew, reschedule and remove),
+                see endpoints.scans.CallbackStore. Defaults to None (callbacks kept in memory only).
+        """
+        self.dead_letter = dead_letter
+        self.store = store
+        tasks = [self.worker() for index in range(self.workers)]
+        if store is not None:
+            tasks.append(self.recover())
+        await asyncio.gather(*tasks)
+
+
+def callback_url(client_ip: str):
+    return CALLBACK_URL.format(client_ip=client_ip)
+
+
+dispatcher = CallbackDispatcher(CALLBACK_WORKERS, secret=getenv("CALLBACK_SECRET") or None)
@@ -0,0 +1,131 @@
+# ------------------------------ PACKAGES ------------------------------
+# Standard imports
+import asyncio
+from dotenv import load_dotenv
+from os import getenv
+from time import monotonic
+
+# Local imports
+import functions.metrics as metrics
+import functions.utils as utils
+from functions.sizing import sizer
+
+
+# ------------------------------ FLEET MANAGER ------------------------------
+class FleetManager:
+    """Keep the axiom_node_* fleet powered while scans are running or queued.
+
+    Scans lease the number of nodes they need instead of powering the fleet on and
+    off themselves. Nodes are only powered off once no scan has run or waited for
+    FLEET_IDLE_TIMEOUT seconds, so back-to-back jobs reuse a warm fleet. Leases are
+    kept in this process, the running jobs of the queue stand for the scans of the
+    other API processes: the fleet is never scaled down while any job is running.
+    """
+
+    def __init__(self, idle_timeout: float, check_interval: float):
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.powered = 0  # Number of nodes currently powered on
+        self.leases = {}  # Lease id -> number of nodes needed by a running scan
+        self.next_lease = 0
+        self.last_busy = monotonic()  # Last time a scan was running or queued
+        self.lock = asyncio.Lock()  # Leases and power off
+        self.boot_lock = asyncio.Lock()  # One boot at a time, scans fitting the warm fleet do not wait for it
+
+    def needed(self):
+        """Number of nodes needed by the running scans."""
+        return max(self.leases.values(), default=0)
+
+    async def acquire(self, count: int, profile: str = None):
+        """Make sure enough nodes are powered for a scan of `count` targets.
+
+        Args:
+            count (int): Number of targets of the scan
+            profile (str, optional): Profile of the scan, used to size the fleet. Defaults to None.
+
+        Returns:
+            int: Lease id to give back to release() at the end of the scan
+        """
+        number = sizer.instances_needed(count, profile)
+        async with self.lock:  # Waits for a scale down in progress
+            # Leased before booting, the fleet is not scaled down under the boot
+            self.next_lease += 1
+            lease = self.next_lease
+            self.leases[lease] = number
+            self.last_busy = monotonic()
+        if number <= self.powered:
+            utils.axiom_log(f"Reusing warm Axiom fleet ({self.powered} instances)")
+            return lease
+        try:
+            async with self.boot_lock:
+                if number > self.powered:  # Not already booted by another scan meanwhile
+                    utils.axiom_log(f"Scaling Axiom fleet up from {self.powered} to {number} instances")
+                    self.powered = len(await self.boot(number))
+            if self.powered == 0:
+                raise RuntimeError("no Axiom instance came up")
+        except BaseException:
+            self.release(lease)
+            raise
+        return lease
+
+    async def boot(self, number: int):
+        """Power on `number` nodes and record how long they took to become reachable."""
+        start = monotonic()
+        ready = await utils.start_instances(number)
+        metrics.fleet_boot.observe(monotonic() - start)
+        return ready
+
+    def leased(self, lease: int):
+        """Number of nodes leased by a scan."""
+        return self.leases.get(lease, 0)
+
+    def release(self, lease: int):
+        """Give back the nodes leased by a finished scan."""
+        self.leases.pop(lease, None)
+
+    async def scale(self, queued: int, running: int):
+        """Power the fleet off once it has been idle for FLEET_IDLE_TIMEOUT seconds.
+
+        Running axiom-scan processes use every node they started on, so the fleet is
+        only scaled down when no scan holds a lease and no job runs in any process.
+
+        Args:
+            queued (int): Number of jobs waiting in the queue
+            running (int): Number of jobs running, in every API process
+        """
+        if queued and self.powered == 0 and not self.boot_lock.locked():
+            # Start booting while the job waits for a worker
+            utils.axiom_log(f"{queued} job(s) queued, warming up the Axiom fleet")
+            async with self.boot_lock:
+                self.powered = len(await self.boot(1))
+        async with self.lock:
+            if queued or running or self.leases or self.boot_lock.locked():
+                self.last_busy = monotonic()
+                return
+            if self.powered == 0 or monotonic() - self.last_busy < self.idle_timeout:
+                return
+            await utils.stop_instances()
+            utils.axiom_log(f"Axiom fleet idle, scaled down from {self.powered} to 0 instances")
+            self.powered = 0
+
+    async def run(self, queue_state):
+        """Watch the queue and power idle nodes off until the application stops.
+
+        Args:
+            queue_state (coroutine function): Returns the number of queued and running jobs
+        """
+        self.powered = len([name for name, ip in await utils.list_instances() if ip])
+        utils.axiom_log(f"Fleet manager started, {self.powered} instances already powered")
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                await self.scale(*await queue_state())
+            except Exception as e:
+                utils.axiom_log(f"Fleet manager error: {e}")
+
+
+load_dotenv()
+manager = FleetManager(
+    idle_timeout=float(getenv("FLEET_IDLE_TIMEOUT", "600")),
+    check_interval=float(getenv("FLEET_CHECK_INTERVAL", "30")),
+)
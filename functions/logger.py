@@ -0,0 +1,210 @@
+# ------------------------------ PACKAGES ------------------------------
+# Standard imports
+import atexit
+import queue
+import sys
+import threading
+from collections import deque
+from datetime import datetime
+from fcntl import LOCK_EX, flock
+from glob import glob
+from os import fstat, getenv, makedirs, path, remove, rename, stat
+from time import monotonic
+
+# Third-party libraries
+from dotenv import load_dotenv
+
+
+# ------------------------------ INIT ------------------------------
+load_dotenv()
+LOG_DIR = getenv("LOG_DIR", "/var/log/dnsscan")
+LOG_FLUSH_INTERVAL = float(getenv("LOG_FLUSH_INTERVAL", "1"))  # Seconds between two flushes
+LOG_BATCH_SIZE = int(getenv("LOG_BATCH_SIZE", "500"))  # Lines written before an early flush
+LOG_MAX_BYTES = int(getenv("LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+LOG_ROTATE_INTERVAL = float(getenv("LOG_ROTATE_INTERVAL", "86400"))  # Seconds, 0 disables it
+LOG_BACKUP_COUNT = int(getenv("LOG_BACKUP_COUNT", "7"))
+LOG_QUEUE_SIZE = int(getenv("LOG_QUEUE_SIZE", "100000"))  # Lines waiting for the writer, newer ones are dropped
+
+# Keywords colouring a line when it is displayed, checked in order per log
+COLOURS = {
+    "api": [(("error", "failed", "fail"), "91"), (("success",), "92")],
+    "axiom": [(("error",), "91"), (("success",), "92")],
+    "database": [(("error",), "91"), (("success",), "92")],
+}
+SEPARATORS = {"api": "startup", "database": "setup"}  # Keyword preceded by blank lines
+
+
+# ------------------------------ WRITER ------------------------------
+class LogFile:
+    """An open log file, rotated on size and age.
+
+    Every API process appends to the same files. A process finding that the path no
+    longer names the file it has open (rotated by another process) opens it again
+    before writing, and rotations are serialised by an flock on {path}.lock, so a
+    file is rotated once whichever processes reach the limits.
+    """
+
+    def __init__(self, name: str):
+        self.path = path.join(LOG_DIR, f"{name}.log")
+        self.open()
+
+    def open(self):
+        makedirs(LOG_DIR, exist_ok=True)
+        self.file = open(self.path, mode="a", encoding="utf-8")
+        opened = fstat(self.file.fileno())
+        self.identity = (opened.st_dev, opened.st_ino)
+        self.size = opened.st_size
+        self.opened_at = monotonic()
+
+    def moved(self):
+        """Whether the path names another file than the open one, or nothing."""
+        try:
+            current = stat(self.path)
+        except FileNotFoundError:
+            return True
+        return (current.st_dev, current.st_ino) != self.identity
+
+    def reopen(self):
+        self.file.close()
+        self.open()
+
+    def write(self, line: str):
+        if self.moved():
+            self.reopen()
+        self.file.write(line)
+
+    def should_rotate(self):
+        self.size = fstat(self.file.fileno()).st_size  # Written by every process
+        if self.size >= LOG_MAX_BYTES:
+            return True
+        return LOG_ROTATE_INTERVAL > 0 and monotonic() - self.opened_at >= LOG_ROTATE_INTERVAL
+
+    def rotate(self):
+        with open(f"{self.path}.lock", mode="a") as lock:
+            flock(lock, LOCK_EX)  # Released when the lock file is closed
+            if not self.moved() and self.size:  # Not rotated by another process meanwhile
+                rename(self.path, f"{self.path}.{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+                for old in sorted(glob(f"{self.path}.[0-9]*"))[:-LOG_BACKUP_COUNT or None]:
+                    remove(old)
+        self.reopen()
+
+
+class LogWriter(threading.Thread):
+    """Single background thread writing every log line, in batches.
+
+    A log that cannot be written loses its lines of the batch, reported on stderr,
+    and is opened again for the next batch. Lines queued while the queue is full are
+    dropped and counted, the count is written to the api log.
+    """
+
+    def __init__(self):
+        super().__init__(name="log-writer", daemon=True)
+        self.records = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.files = {}
+        self.dropped = 0  # Lines dropped because the queue was full
+        self.reported = 0  # Dropped lines already reported
+        self.dropped_lock = threading.Lock()
+
+    def run(self):
+        while True:
+            batch = []
+            try:
+                batch.append(self.records.get(timeout=LOG_FLUSH_INTERVAL))
+                while len(batch) < LOG_BATCH_SIZE:
+                    batch.append(self.records.get_nowait())
+            except queue.Empty:
+                pass
+            if self.dropped > self.reported:
+                dropped, self.reported = self.dropped - self.reported, self.dropped
+                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                batch.append(("api", f"{timestamp} - LOG ERROR, {dropped} lines dropped, the log queue was full\n"))
+            if batch:
+                self.write(batch)
+            if None in batch:  # Stop marker
+                return
+
+    def write(self, batch):
+        lines = {}
+        for record in batch:
+            if record is not None:
+                lines.setdefault(record[0], []).append(record[1])
+        for name, name_lines in lines.items():
+            try:
+                if name not in self.files:
+                    self.files[name] = LogFile(name)
+                log_file = self.files[name]
+                log_file.write("".join(name_lines))
+                log_file.file.flush()
+                if log_file.should_rotate():
+                    log_file.rotate()
+            except Exception as e:
+                print(f"LOG ERROR, {len(name_lines)} lines of the {name} log lost : {e}", file=sys.stderr)
+                log_file = self.files.pop(name, None)
+                if log_file is not None:
+                    try:
+                        log_file.file.close()
+                    except Exception:
+                        pass
+
+    def put(self, record):
+        """Queue a record without blocking, it is dropped and counted if the queue is full."""
+        try:
+            self.records.put_nowait(record)
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+    def stop(self):
+        """Write what is still queued and stop the thread."""
+        try:
+            self.records.put(None, timeout=5)
+        except queue.Full:
+            return
+        self.join(timeout=5)
+
+
+writer = LogWriter()
+writer.start()
+atexit.register(writer.stop)
+
+
+def write(name: str, message):
+    """Queue a timestamped line for the `name` log, never blocks the caller.
+
+    Args:
+        name (str): Log name (api, axiom, database), written to LOG_DIR/{name}.log
+        message (str|bytes): Message to log
+    """
+    if isinstance(message, bytes):
+        message = message.decode("utf-8", errors="replace")
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    write_line(name, f"{timestamp} - {str(message).strip()}")
+
+
+def write_line(name: str, line: str):
+    """Queue a line as is (no timestamp) for the `name` log, e.g. a JSON record."""
+    writer.put((name, f"{line}\n"))
+
+
+# ------------------------------ READER ------------------------------
+def colorize(name: str, line: str):
+    """Colour a log line for the terminal, the files themselves contain plain text."""
+    lowered = line.lower()
+    separator = SEPARATORS.get(name)
+    prefix = "\n\n" if separator and separator in lowered else ""
+    for keywords, colour in COLOURS.get(name, []):
+        if any(keyword in lowered for keyword in keywords):
+            return f"{prefix}\033[{colour}m{line}\033[0m"
+    return f"{prefix}{line}"
+
+
+def show(name: str, lines: int = 100):
+    """Print the last lines of a log with colours."""
+    with open(path.join(LOG_DIR, f"{name}.log"), encoding="utf-8") as log:
+        for line in deque(log, maxlen=lines):
+            print(colorize(name, line.rstrip("\n")))
+
+
+if __name__ == "__main__":
+    # python3 -m functions.logger api [lines]
+    show(sys.argv[1] if len(sys.argv) > 1 else "api", int(sys.argv[2]) if len(sys.argv) > 2 else 100)
@@ -0,0 +1,131 @@
+# ------------------------------ PACKAGES ------------------------------
+# Standard imports
+import threading
+from bisect import bisect_left
+from math import inf
+
+
+# ------------------------------ INIT ------------------------------
+SECONDS_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400)
+RATE_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+registry = []  # Every metric, in the order they are exposed
+
+
+# ------------------------------ METRICS ------------------------------
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: tuple, values: tuple, extra: str = ""):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float):
+    if value == inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    """A metric of this process, exposed in the Prometheus text format."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}  # Label values -> value
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def key(self, labels: dict):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self.samples(key, value))
+        return lines
+
+    def samples(self, key, value):
+        return [f"{self.name}{format_labels(self.labels, key)} {format_value(value)}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = SECONDS_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (inf,)
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            labels = format_labels(self.labels, key, f'le="{format_value(bound)}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.labels, key)
+        lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render():
+    """Every metric in the Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ------------------------------ SCAN METRICS ------------------------------
+queue_wait = Histogram(
+    "scan_queue_wait_seconds", "Time between the submission of a scan job and its start.", ("profile",)
+)
+fleet_boot = Histogram("fleet_boot_seconds", "Time to power on Axiom nodes until they are reachable.")
+axiom_runtime = Histogram(
+    "axiom_scan_seconds", "Run time of one axiom-scan invocation.", ("profile", "tool", "status")
+)
+targets_rate = Histogram(
+    "axiom_scan_targets_per_second",
+    "Targets scanned per second by a successful axiom-scan invocation.",
+    ("profile", "tool"),
+    RATE_BUCKETS,
+)
+upload_time = Histogram("s3_upload_seconds", "Time to save a scan output in S3.", ("format", "status"))
+scans_finished = Counter("scan_jobs_finished_total", "Scan jobs finished.", ("profile", "status"))
+queue_jobs = Gauge("scan_queue_jobs", "Scan jobs in the queue.", ("status",))
+fleet_nodes = Gauge("fleet_nodes", "Axiom nodes powered on and nodes needed by running scans.", ("state",))
+db_pool = Gauge("db_pool_connections", "Connections of the database pool.", ("state",))
+db_pool_wait = Gauge("db_pool_wait_seconds_max", "Longest wait for a database connection.")
@@ -0,0 +1,49 @@
+# ------------------------------ PACKAGES ------------------------------
+# Standard imports
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from os import getenv
+
+# Third-party libraries
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+
+# ------------------------------ INIT ------------------------------
+load_dotenv()
+HASH_WORKERS = int(getenv("HASH_WORKERS", "2"))  # bcrypt calls running at once
+HASH_QUEUE_LIMIT = int(getenv("HASH_QUEUE_LIMIT", "32"))  # bcrypt calls running or waiting
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="bcrypt")
+pending = 0
+
+
+# -------------------------------- PASSWORD --------------------------------
+async def run_hashing(function, *args):
+    """Run a bcrypt call on the hashing executor instead of the event loop.
+
+    Raises:
+        HTTPException: 429 when HASH_QUEUE_LIMIT calls are already running or waiting
+    """
+    global pending
+    if pending >= HASH_QUEUE_LIMIT:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many authentication requests, retry later",
+            headers={"Retry-After": "1"},
+        )
+    pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+    finally:
+        pending -= 1
+
+
+async def get_password_hash(password: str) -> str:
+    return await run_hashing(pwd_context.hash, password)
+
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await run_hashing(pwd_context.verify, plain_password, hashed_password)
@@ -0,0 +1,156 @@
+# ------------------------------ PACKAGES ------------------------------
+# Standard imports
+import asyncio
+from collections import deque
+from os import killpg
+from signal import SIGKILL
+from subprocess import DEVNULL, PIPE
+from typing import Callable, NamedTuple, Optional
+
+
+# ------------------------------ COMMAND RUNNER ------------------------------
+STREAM_LIMIT = 1024 * 1024  # Longest line read at once from a process output
+STREAM_DRAIN_TIMEOUT = 5  # Seconds the output is still read once the process has exited or been killed
+EXIT_POLL_INTERVAL = 0.2  # Seconds between two checks of the exit of a process
+
+
+class CommandResult(NamedTuple):
+    returncode: int
+    stdout: str
+    stderr: str
+    timed_out: bool = False
+
+
+async def read_stream(stream, on_line: Optional[Callable], max_output: int):
+    """Read a process stream line by line.
+
+    A line longer than STREAM_LIMIT is passed on in pieces of at most STREAM_LIMIT
+    bytes, nothing is dropped.
+
+    Args:
+        stream (asyncio.StreamReader): stdout or stderr of the process
+        on_line (Callable, optional): Called with every decoded line as soon as it is read
+        max_output (int): Maximum number of characters kept, older lines are dropped first
+
+    Returns:
+        str: The last `max_output` characters of the stream
+    """
+    kept = deque()
+    size = 0
+    while True:
+        try:
+            raw = await stream.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:  # Last line without a newline, empty at the end
+            raw = e.partial
+        except asyncio.LimitOverrunError as e:  # Line longer than the stream limit, still in the buffer
+            raw = await stream.read(min(e.consumed, STREAM_LIMIT))
+        if not raw:
+            break
+        line = raw.decode("utf-8", errors="replace")
+        if on_line is not None:
+            on_line(line.rstrip("\n"))
+        kept.append(line)
+        size += len(line)
+        while size > max_output and len(kept) > 1:
+            size -= len(kept.popleft())
+    return "".join(kept)
+
+
+def kill_group(process):
+    """Kill a process and every process it started, they share its process group."""
+    try:
+        killpg(process.pid, SIGKILL)
+    except ProcessLookupError:  # Every process of the group has already exited
+        pass
+
+
+async def wait_exit(process):
+    """Wait for a process to exit.
+
+    Process.wait() also waits for the stdout/stderr pipes, which children still
+    running keep open, so the return code set by the child watcher is polled instead.
+    """
+    while process.returncode is None:
+        await asyncio.sleep(EXIT_POLL_INTERVAL)
+    return process.returncode
+
+
+async def stop_process(process):
+    """Kill a process and its children, and reap it so it does not linger as a zombie."""
+    kill_group(process)
+    await wait_exit(process)
+
+
+async def drain(process, streams: list):
+    """Wait for the readers of the process streams.
+
+    Children left behind by the process (shell scripts such as axiom-scan start
+    their own) keep the pipes open: after STREAM_DRAIN_TIMEOUT seconds they are
+    killed, and the readers are given up after STREAM_DRAIN_TIMEOUT more seconds.
+
+    Returns:
+        list: Output of each stream, what was read so far for a reader given up
+    """
+    done, pending = await asyncio.wait(streams, timeout=STREAM_DRAIN_TIMEOUT)
+    if pending:
+        kill_group(process)
+        done, pending = await asyncio.wait(pending, timeout=STREAM_DRAIN_TIMEOUT)
+        for task in pending:
+            task.cancel()
+    return [task.result() if not task.cancelled() else "" for task in streams]
+
+
+async def run(
+    args: list,
+    timeout: Optional[float] = None,
+    env: Optional[dict] = None,
+    stdin=DEVNULL,
+    on_stdout: Optional[Callable] = None,
+    on_stderr: Optional[Callable] = None,
+    max_output: int = 1_000_000,
+):
+    """Run a command without blocking the event loop.
+
+    The command is executed directly (no shell), in a session of its own. Its output
+    is streamed to the callbacks while it runs. The process and every process it
+    started are killed if the timeout expires or if the calling task is cancelled.
+
+    Args:
+        args (list): Program and its arguments
+        timeout (float, optional): Seconds before the process is killed. Defaults to None (no limit).
+        env (dict, optional): Environment of the process. Defaults to the current environment.
+        stdin (optional): stdin of the process (file descriptor). Defaults to DEVNULL.
+        on_stdout (Callable, optional): Called with every stdout line. Defaults to None.
+        on_stderr (Callable, optional): Called with every stderr line. Defaults to None.
+        max_output (int, optional): Characters of each stream kept in the result. Defaults to 1_000_000.
+
+    Returns:
+        CommandResult: Return code, captured stdout/stderr and whether the timeout expired
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *[str(arg) for arg in args],
+            stdin=stdin,
+            stdout=PIPE,
+            stderr=PIPE,
+            env=env,
+            limit=STREAM_LIMIT,
+            start_new_session=True,  # Its children can be killed with it
+        )
+    except OSError as e:
+        return CommandResult(127, "", str(e))
+    stdout = asyncio.create_task(read_stream(process.stdout, on_stdout, max_output))
+    stderr = asyncio.create_task(read_stream(process.stderr, on_stderr, max_output))
+    timed_out = False
+    try:
+        await asyncio.wait_for(wait_exit(process), timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+        await stop_process(process)
+    except asyncio.CancelledError:
+        await stop_process(process)
+        stdout.cancel()
+        stderr.cancel()
+        raise
+    output, errors = await drain(process, [stdout, stderr])
+    return CommandResult(process.returncode, output, errors, timed_out)
@@ -1,18 +1,33 @@
 # ------------------------------ PACKAGES ------------------------------
 # General packages
 import asyncio
-import subprocess
+import json
 import pty
-from requests import exceptions, post
+import shlex
 from datetime import datetime
-from os import getenv, path
+from time import monotonic
+from os import close, getenv, path, remove
+from uuid import uuid4
 # Internal packages
+import functions.callbacks as callbacks
+import functions.metrics as metrics
+import functions.runner as runner
+import functions.targets as targets
 import functions.utils as utils
+from functions.fleet import manager as fleet
+from functions.sizing import sizer
+from functions.storage import storage
 
 
+# ------------------------------ INIT ------------------------------
+SHARD_TARGETS_PER_NODE = int(getenv("SCAN_SHARD_TARGETS_PER_NODE", "500"))  # Shard size per fleet node
+SHARD_ATTEMPTS = int(getenv("SCAN_SHARD_ATTEMPTS", "2"))  # Runs of a failing shard before the job fails
+
 
 # ------------------------------ PROCESSING ------------------------------
-async def processing(q, domain, output="", uuid="", client_ip=""):
+async def processing(
+    q, domain, output="", uuid="", client_ip="", progress=None, cache=None, tracker=None
+):
     """Prepare API request for the scan and call it
 
     Args:
@@ -21,26 +36,224 @@ async def processing(q, domain, output="", uuid="", client_ip=""):
         output (str, optional): Output type. Default empty.
         uuid (str, optional): Job UUID, it will be used to send a response and as a str in the filename. Default empty.
         client_ip (str, optional): Requester IP address used to send result. Default empty.
+        progress (dict, optional): Updated with the number of targets and output lines while the scan runs. Default None.
+        cache (ResultCache, optional): Cache of recent results, cached targets are not scanned again. Default None.
+        tracker (ShardTracker, optional): Stores the status of each shard of the input. Default None.
+
+    Returns:
+        dict: Job status ("completed"/"error"), scan exit code, S3 key of the result
+            (None if every target was cached) and S3 keys of the cached results reused
     """
     utils.api_log(
         f"API call received. Start processing for {domain}. The uuid is {uuid} and client_ip is {client_ip}"
     )
-    domain, ext = path.splitext(input)
-    current_datetime = datetime.now().strftime("%Y-%m-%d")
-    file = f"{current_datetime}_{domain}" if not uuid else f"{current_datetime}_{domain}_{uuid}"
+    file = output_filename(domain, uuid)
     utils.api_log(f"Output filename: {file}")
 
-    code = await scan(input=domain, output=file, profile=(q.value), format=output)
+    code = await scan(
+        input=domain,
+        output=file,
+        profile=q,
+        format=output,
+        progress=progress,
+        cache=cache,
+        tracker=tracker,
+    )
 
     status = "completed" if code == 0 else "error"
-    
+    cached_keys = cache.keys if cache is not None else []
+    s3_key = f"scan_output/{file}.{output}" if code == 0 else None  # Upload confirmed by scan()
+    if code == 0 and cache is not None and cache.complete:
+        s3_key = None
+        file = path.splitext(path.basename(cached_keys[0]))[0]
+
     if uuid and client_ip:
-        await notify(status, file, uuid, client_ip)
-    return status
+        notify(status, file, uuid, client_ip)
+    return {"status": status, "exit_code": code, "s3_key": s3_key, "cached_keys": cached_keys}
+
+
+def output_filename(domain, uuid=""):
+    """Output filename (without extension) of a job: date, input name and uuid if any."""
+    name, ext = path.splitext(domain)
+    current_datetime = datetime.now().strftime("%Y-%m-%d")
+    return f"{current_datetime}_{name}" if not uuid else f"{current_datetime}_{name}_{uuid}"
+
+
+async def processing_batch(q, jobs, output="", progress=None, cache=None):
+    """Scan the targets of several single-target jobs in one axiom-scan run, then split the result per job
+
+    Args:
+        q (str): Profile shared by the jobs
+        jobs (list): dict with the input filename, uuid and client_ip of each job
+        output (str, optional): Output type shared by the jobs. Default empty.
+        progress (dict, optional): Updated with the number of targets and output lines while the scan runs. Default None.
+        cache (ResultCache, optional): Cache of recent results, cached targets are not scanned again. Default None.
+
+    Returns:
+        list: One dict per job, as returned by processing
+    """
+    batch = f"batch_{uuid4().hex[:8]}"
+    results = [{"status": "error", "exit_code": 1, "s3_key": None, "cached_keys": []} for job in jobs]
+    owners = {}  # Host of a target -> index of the jobs asking for it
+    # Job inputs are kept until their status is stored, a re-leased job still finds it
+    with open(f"/var/tmp/scan_input/{batch}.txt", "w", encoding="utf-8") as merged:
+        for index, job in enumerate(jobs):
+            input_path = f"/var/tmp/scan_input/{job['input']}"
+            if not path.exists(input_path):
+                utils.api_log(f"Input file {input_path} not found, job discarded from {batch}")
+                continue
+            with open(input_path, encoding="utf-8") as source:
+                for line in source:
+                    target = targets.normalise(line)
+                    if target is None:
+                        continue
+                    indexes = owners.setdefault(targets.host_of(target), [])
+                    if not indexes:  # Scanned once for every job asking for it
+                        merged.write(f"{target}\n")
+                    if index not in indexes:
+                        indexes.append(index)
+    utils.api_log(f"{len(jobs)} {q} jobs merged into {batch} ({len(owners)} distinct targets)")
+
+    file = output_filename(batch)
+    code = await scan(
+        input=f"{batch}.txt",
+        output=file,
+        profile=q,
+        format=output,
+        progress=progress,
+        cache=cache,
+        keep_output=True,  # Split below, then deleted
+    )
+    batch_output = f"/var/tmp/scan_output/{file}.{output}"
+    if code != 0:
+        if path.exists(batch_output):
+            remove(batch_output)
+        for job in jobs:
+            if job["uuid"] and job["client_ip"]:
+                notify("error", output_filename(job["input"], job["uuid"]), job["uuid"], job["client_ip"])
+        return results
+
+    # Results of cached targets are not in the batch output, the job gets the cached object instead
+    cached = {}
+    if cache is not None:
+        cached = {targets.host_of(target): key for target, key in cache.hits.items()}
+        if cache.complete and not cached:  # The whole batch was a single cached result
+            cached = {host: cache.keys[0] for host in owners}
+    # One output per job, even if two jobs share an input name and uuid
+    files = [output_filename(job["input"], job["uuid"]) for job in jobs]
+    files = [file if files.index(file) == index else f"{file}_{index}" for index, file in enumerate(files)]
+    written = await asyncio.to_thread(split_output, batch_output, output, owners, files)
+    if path.exists(batch_output):
+        remove(batch_output)
+    for index, (job, result) in enumerate(zip(jobs, results)):
+        hosts = [host for host, indexes in owners.items() if index in indexes]
+        if not hosts:
+            continue
+        result.update(status="completed", exit_code=0)
+        result["cached_keys"] = sorted({cached[host] for host in hosts if host in cached})
+        if index in written or not result["cached_keys"]:
+            if index not in written:  # Nothing found for this target, its result is empty
+                open(f"/var/tmp/scan_output/{files[index]}.{output}", "w", encoding="utf-8").close()
+            if await storage.upload_output(f"{files[index]}.{output}"):
+                result["s3_key"] = f"scan_output/{files[index]}.{output}"
+            else:
+                result.update(status="error", exit_code=1)
+        if job["uuid"] and job["client_ip"]:
+            notify(result["status"], files[index], job["uuid"], job["client_ip"])
+    return results
+
+
+def split_output(output_path, format, owners, files):
+    """Write each line of a batch output to the output file of the jobs whose target starts it
+
+    Args:
+        output_path (str): Batch output file
+        format (str): Output type, json lines are matched on their input/host/url field
+        owners (dict): Host -> indexes of the jobs asking for it
+        files (list): Output filename (without extension) of each job
+
+    Returns:
+        set: Indexes of the jobs with at least one line written
+    """
+    written = {}
+    dropped = 0
+    if not path.exists(output_path):
+        return set()
+    try:
+        with open(output_path, encoding="utf-8", errors="replace") as source:
+            for line in source:
+                if not line.strip():
+                    continue
+                key = line
+                if format == "json":
+                    try:
+                        record = json.loads(line)
+                        key = str(record.get("input") or record.get("host") or record.get("url") or "")
+                    except (ValueError, AttributeError):
+                        key = ""
+                indexes = owners.get(targets.host_of(key))
+                if not indexes:
+                    dropped += 1
+                    continue
+                for index in indexes:
+                    if index not in written:
+                        written[index] = open(
+                            f"/var/tmp/scan_output/{files[index]}.{format}", "w", encoding="utf-8"
+                        )
+                    written[index].write(line if line.endswith("\n") else f"{line}\n")
+    finally:
+        for job_file in written.values():
+            job_file.close()
+    if dropped:
+        utils.axiom_log(f"{dropped} lines of {output_path} did not match any job of the batch")
+    return set(written)
+
+
+# ------------------------------ WORKFLOWS ------------------------------
+def workflow_stages(workflow):
+    """Stages of a workflow, run by functions.workflow
+
+    A stage reads the targets found by the stages it depends on, stages without
+    dependency read the submitted input.
+
+    Args:
+        workflow (str): Workflow chosen
+
+    Returns:
+        dict: Stage name -> (profile, names of the stages it depends on), None for an invalid workflow
+    """
+    stages = None
+    match workflow:
+        case "recon":
+            stages = {
+                "hosts": ("ip_list", []),
+                "ports": ("port_scan", ["hosts"]),
+                "http": ("http_check", ["hosts"]),
+                "screenshots": ("web_scan", ["http"]),
+            }
+        case "web_recon":
+            stages = {
+                "http": ("http_check", []),
+                "waf": ("waf_check", ["http"]),
+                "ssl": ("ssl_check", ["http"]),
+                "urls": ("web_list", ["http"]),
+            }
+        case "exposure":
+            stages = {
+                "hosts": ("ip_list", []),
+                "ports": ("port_scan", ["hosts"]),
+            }
+        case _:
+            utils.axiom_log(f"Invalid workflow: {workflow}, discarding scan")
+            return None
+    utils.axiom_log(f"Workflow {workflow}: {', '.join(stages)}")
+    return stages
 
 
 # ------------------------- Main scan function -------------------------
-async def scan(input, output, profile=None, format=""):
+async def scan(
+    input, output, profile=None, format="", progress=None, cache=None, keep_output=False, tracker=None
+):
     """Run axiom-scan based on arguments provided
 
     Args:
@@ -48,15 +261,20 @@ async def scan(input, output, profile=None, format=""):
         output (str): Output filename
         profile (str, optional): Single scan case. Defaults to None.
         format (str, optional): Output type. Default empty.
+        progress (dict, optional): Updated with the number of targets and output lines. Defaults to None.
+        cache (ResultCache, optional): Cache of recent results, looked up before booting the fleet. Defaults to None.
+        keep_output (bool, optional): Keep the local output after it is saved in S3. Defaults to False.
+        tracker (ShardTracker, optional): Stores the status of each shard of the input. Defaults to None.
 
     Returns:
-        code: return error/success code
+        code: return error/success code, 0 only once the output is confirmed in S3
     """
+    if progress is None:
+        progress = {}
     if format is None:
         format = ""
     tool = None
     outype = None
-    count = 0
     utils.axiom_log("-----------------------")
     match profile:
         case "ip_list":
@@ -68,10 +286,8 @@ async def scan(input, output, profile=None, format=""):
             tool = "gau"
         case "waf_check":
             tool = "wafw00f"
-            utils.add_https_to_each_line(input)
         case "ssl_check":
             tool = "testssl"
-            utils.add_https_to_each_line(input)
         case "http_check":
             tool = "httpx -fr -sc -location -title -method"
         case "dns_check":
@@ -98,75 +314,232 @@ async def scan(input, output, profile=None, format=""):
             utils.axiom_log("-----------------------")
             return 1
     utils.axiom_log(f"Output format: {outype}")
-    count = 0
-    # Determine the file type and count the number of lines, entries, or rows
-    if ".json" in input:
-        count = utils.count_entries_in_json(f"/var/tmp/scan_input/{input}")
-    elif ".csv" in input:
-        count = utils.count_rows_in_csv(f"/var/tmp/scan_input/{input}")
-    elif ".txt" in input:
-        count = utils.count_lines_in_txt(f"/var/tmp/scan_input/{input}")
-    else:
-        utils.axiom_log(f"Incorrect input filename : {input}")
-
-    with open(f"/var/tmp/scan_input/{input}", "r") as file:
-        lines_list = [line.strip() for line in file.readlines()]
-    await utils.instances_needed(count)  # Start needed instances
-
-    starttime = datetime.now().strftime("%H:%M:%S")
-    await axiom(tool, outype, input, f"/var/tmp/scan_output/{output}", profile)
-    endtime = datetime.now().strftime("%H:%M:%S")
-
-    utils.save_to_bucket(f"{output}.{format}")
-
-    length = f"{starttime} - {endtime}"
-    utils.cert_json(lines_list, tool, length)
-    utils.stop_instances()
-    subprocess.run(
-        [f"rm /var/tmp/scan_input/{input}"],
-        shell=True,
-        check=False
+    # Normalise, validate, deduplicate and count the targets in a single pass
+    input_path = f"/var/tmp/scan_input/{input}"
+    stats = await asyncio.to_thread(targets.prepare, input_path, profile)
+    count = stats["count"]
+    utils.axiom_log(
+        f"{count} targets prepared for {profile} ({stats['invalid']} invalid, {stats['duplicates']} duplicates dropped)"
     )
+    progress["targets"] = count
+    if count == 0:
+        utils.axiom_log(f"Error, no valid target in {input}, discarding scan")
+        utils.axiom_log("-----------------------")
+        return 1
+    if cache is not None:
+        # Only the targets without a fresh result are scanned
+        count = await cache.split(input_path, stats)
+        if cache.keys:
+            utils.axiom_log(f"{stats['count'] - count} targets served from cached results {cache.keys}")
+        if count == 0:
+            remove(input_path)
+            utils.axiom_log("-----------------------")
+            return 0
+
+    lease = await fleet.acquire(count, profile)  # Power on needed instances, if not already warm
+    try:
+        starttime = datetime.now()
+        code = await run_shards(
+            tool, outype, input, output, profile, format, count, fleet.leased(lease), progress, tracker
+        )
+        endtime = datetime.now()
+
+        saved = await storage.upload_output(f"{output}.{format}", delete=not keep_output)
+        if code == 0 and not saved:
+            utils.axiom_log(f"Error, {output}.{format} is not in the S3 bucket, the scan failed")
+            code = 1
+        if code == 0 and cache is not None:
+            await cache.store(input_path, stats, f"scan_output/{output}.{format}")
+
+        await utils.cert_json(input_path, tool, starttime, endtime)
+    finally:
+        fleet.release(lease)
+    if path.exists(input_path):
+        remove(input_path)
     utils.axiom_log("-----------------------")
+    return code
+
+async def run_shards(
+    module, outype, input, output, profile, format, count, instances, progress=None, tracker=None
+):
+    """Run axiom-scan over shards of the input sized to the fleet, retrying the failed shards only
+
+    Each shard keeps every node leased for the whole input busy
+    (SCAN_SHARD_TARGETS_PER_NODE targets per node). Shards run one after the other on
+    the leased fleet and their outputs are merged into the output of the scan.
+    HTML reports and aquatone directories cannot be merged, they are never sharded.
+
+    Args:
+        module (str): Tool command passed to axiom-scan -m
+        outype (str): axiom-scan output option (-o, -oJ, -oH)
+        input (str): Prepared input filename
+        output (str): Output filename without extension
+        profile (str): Profile name, used in the log
+        format (str): Output type
+        count (int): Number of targets of the input
+        instances (int): Nodes leased by the scan
+        progress (dict, optional): Updated with the number of output lines read. Defaults to None.
+        tracker (ShardTracker, optional): Stores the status of each shard. Defaults to None.
+
+    Returns:
+        code: 0 if every shard succeeded, 1 otherwise
+    """
+    input_path = f"/var/tmp/scan_input/{input}"
+    output_path = f"/var/tmp/scan_output/{output}"
+    shard_size = max(instances, 1) * SHARD_TARGETS_PER_NODE
+    if count <= shard_size or format == "html" or profile == "web_scan":
+        if tracker is not None:
+            await tracker.plan([count])
+            await tracker.update(0, "running")
+        code = await timed_axiom(module, outype, input, output_path, profile, count, instances, progress)
+        if tracker is not None:
+            await tracker.update(0, "completed" if code == 0 else "error", code)
+        return code
+
+    sizes = await asyncio.to_thread(targets.split_file, input_path, shard_size)
+    done = set()
+    if tracker is not None:
+        # Shards completed by a previous attempt of the job are kept if their output is still here
+        done = {
+            index for index in await tracker.plan(sizes)
+            if shard_output(f"{output_path}.shard{index}", format)
+        }
+    utils.axiom_log(f"{count} targets split into {len(sizes)} shards, {len(done)} already completed")
+    for attempt in range(1, SHARD_ATTEMPTS + 1):
+        pending = [index for index in range(len(sizes)) if index not in done]
+        if not pending:
+            break
+        if attempt > 1:
+            utils.axiom_log(f"Retrying {len(pending)} failed shards (attempt {attempt})")
+        for index in pending:
+            if tracker is not None:
+                await tracker.update(index, "running")
+            code = await timed_axiom(
+                module,
+                outype,
+                f"{input}.shard{index}",
+                f"{output_path}.shard{index}",
+                profile,
+                sizes[index],
+                instances,
+                progress,
+                f"{profile} {index + 1}/{len(sizes)}",
+            )
+            if code == 0:
+                done.add(index)
+            if tracker is not None:
+                await tracker.update(index, "completed" if code == 0 else "error", code)
+
+    await asyncio.to_thread(merge_outputs, output_path, format, len(sizes))
+    for index in range(len(sizes)):
+        if path.exists(f"{input_path}.shard{index}"):
+            remove(f"{input_path}.shard{index}")
+    if len(done) < len(sizes):
+        utils.axiom_log(f"Error, {len(sizes) - len(done)} of {len(sizes)} shards failed, see error above")
+        return 1
     return 0
 
-async def notify(status, file, uuid, client_ip):
-    try:
-        callback_url = f"http://{client_ip}/callback"
-        response = post(callback_url, json={"status": status, "file": file, "uuid": uuid})
-        response.raise_for_status()
-    except exceptions.RequestException as e:
-        utils.api_log(f"Failed to notify client IP: {client_ip}, error: {e}")
+
+async def timed_axiom(module, outype, input, output, profile, count, instances, progress=None, label=None):
+    """Run axiom() and record its run time on the leased nodes so the fleet sizing learns the costs of the profile."""
+    start = monotonic()
+    code = await axiom(module, outype, input, output, label or profile, progress)
+    seconds = monotonic() - start
+    tool = module.split()[0]
+    metrics.axiom_runtime.observe(
+        seconds, profile=profile, tool=tool, status="completed" if code == 0 else "error"
+    )
+    if code == 0:
+        sizer.record(profile, count, seconds, instances)
+        if seconds > 0:
+            metrics.targets_rate.observe(count / seconds, profile=profile, tool=tool)
+    return code
+
+
+def shard_output(output_path, format):
+    """Output file written by axiom-scan for an output path, None if there is none."""
+    for candidate in (f"{output_path}.{format}", output_path):
+        if path.isfile(candidate):
+            return candidate
+    return None
 
 
-async def axiom(module, outype, input, output, profile):
-    axiom_path = getenv("AXIOM_PATH")
+def merge_outputs(output_path, format, shards):
+    """Concatenate the txt/json lines outputs of the shards, in order, and delete them."""
+    with open(f"{output_path}.{format}", "w", encoding="utf-8") as merged:
+        for index in range(shards):
+            source_path = shard_output(f"{output_path}.shard{index}", format)
+            if source_path is None:
+                continue
+            with open(source_path, encoding="utf-8", errors="replace") as source:
+                for line in source:
+                    merged.write(line if line.endswith("\n") else f"{line}\n")
+            remove(source_path)
+
+
+def notify(status, file, uuid, client_ip):
+    """Queue the end of scan callback to the requester, it is sent in the background with retries."""
+    callbacks.dispatcher.send(
+        callbacks.callback_url(client_ip), {"status": status, "file": file, "uuid": uuid}
+    )
+
+
+async def axiom(module, outype, input, output, profile, progress=None):
+    """Run axiom-scan and stream its output to the log line by line
+
+    Args:
+        module (str): Tool command passed to axiom-scan -m
+        outype (str): axiom-scan output option (-o, -oJ, -oH)
+        input (str): Input filename
+        output (str): Output path without extension
+        profile (str): Profile name, used in the log
+        progress (dict, optional): Updated with the number of output lines read. Defaults to None.
+
+    Returns:
+        code: return error/success code
+    """
     home = getenv("HOME")
     env = {
         "TERM": "xterm",
         "HOME": str(home),
         "PATH": "/home/ubuntu/go/bin:/usr/local/go/bin:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin:/usr/games:/usr/local/games:/snap/bin:/home/ubuntu/.local/bin:/home/ubuntu/.axiom/interact"
     }
-    command = f"{axiom_path}axiom-scan /var/tmp/scan_input/{input} -m {module} {outype} {output}"
+    command = f"{utils.axiom_command('axiom-scan')} /var/tmp/scan_input/{input} -m {module} {outype} {output}"
     utils.axiom_log(f"Start of {profile} for /var/tmp/scan_input/{input}")
     utils.axiom_log(f"{command}")
+    if progress is None:
+        progress = {}
+    progress.setdefault("lines", 0)  # Shards of a scan add up
+    exiting = False
+
+    def on_stdout(line):
+        nonlocal exiting
+        progress["lines"] += 1
+        exiting = exiting or "exiting" in line
+        utils.axiom_log(f"[{profile}] {line}")
+
+    def on_stderr(line):
+        utils.axiom_log(f"[{profile}] stderr: {line}")
+
     master_fd, slave_fd = pty.openpty()
-    process = subprocess.Popen(
-        command, shell=True, stdin=slave_fd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=env, close_fds=True
-    )
-    stdout, stderr = await asyncio.get_event_loop().run_in_executor(None, process.communicate)
-    if process.returncode != 0 or "exiting" in stdout:
-        utils.axiom_log("Command failed with error: ")
-        utils.axiom_log(stderr)
-        utils.axiom_log("Command output: ")
-        utils.axiom_log(stdout)
+    try:
+        result = await runner.run(
+            shlex.split(command),
+            env=env,
+            stdin=slave_fd,
+            on_stdout=on_stdout,
+            on_stderr=on_stderr,
+            max_output=0,  # Output is already in the log, keep nothing in memory
+        )
+    finally:
+        close(master_fd)
+        close(slave_fd)
+    if result.returncode != 0 or exiting:
         utils.axiom_log(
-            f"End of {profile} using {module}, see error at: /var/log/dnsscan/axiom.log"
+            f"End of {profile} using {module} with error (exit code {result.returncode}), see error at: /var/log/dnsscan/axiom.log"
         )
         return 1
-    utils.axiom_log("Command output:")
-    utils.axiom_log(stdout)
     utils.axiom_log(
-        f"End of {profile} using {module}, succesfull result: {output}\n"
+        f"End of {profile} using {module}, succesfull result: {output} ({progress['lines']} output lines)\n"
     )
-    return 0
\ No newline at end of file
+    return 0
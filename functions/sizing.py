@@ -0,0 +1,200 @@
+# ------------------------------ PACKAGES ------------------------------
+# Standard imports
+import json
+import threading
+from dotenv import load_dotenv
+from math import ceil
+from os import getenv, makedirs, path, replace
+
+# Local imports
+import functions.utils as utils
+from functions.logger import LOG_DIR
+
+
+# ------------------------------ INIT ------------------------------
+load_dotenv()
+RANGES_FILE = "./data/config.json"
+SIZING_FILE = "./data/sizing.json"
+HISTORY_FILE = getenv("SIZING_HISTORY_FILE", path.join(LOG_DIR, "sizing_history.json"))
+
+
+# ------------------------------ CONFIG ------------------------------
+def load_ranges(file_path: str = RANGES_FILE):
+    """Read and validate the line count ranges of data/config.json.
+
+    Ranges must be sorted, start at 0 and follow each other without gap or overlap.
+    The last one may be open-ended ("max_lines": null), otherwise larger inputs get
+    the instances of the last range.
+
+    Raises:
+        ValueError: The ranges are not valid
+
+    Returns:
+        list: (min_lines, max_lines or None, instances) tuples
+    """
+    with open(file_path, encoding="utf-8") as config_file:
+        entries = json.load(config_file)
+    ranges = []
+    expected = 0
+    for position, entry in enumerate(entries):
+        low, high, instances = entry.get("min_lines"), entry.get("max_lines"), entry.get("instances")
+        if low != expected:
+            raise ValueError(f"{file_path}: range {position} starts at {low}, expected {expected}")
+        if high is None and position != len(entries) - 1:
+            raise ValueError(f"{file_path}: only the last range can be open-ended")
+        if high is not None and high < low:
+            raise ValueError(f"{file_path}: range {position} ends before it starts")
+        if not isinstance(instances, int) or instances < 1:
+            raise ValueError(f"{file_path}: range {position} needs at least 1 instance")
+        ranges.append((low, high, instances))
+        expected = high + 1 if high is not None else None
+    if not ranges:
+        raise ValueError(f"{file_path}: no range defined")
+    return ranges
+
+
+def load_sizing(file_path: str = SIZING_FILE):
+    """Read and validate data/sizing.json, FLEET_SLA_SECONDS and FLEET_MAX_INSTANCES override it.
+
+    Raises:
+        ValueError: A setting is not valid
+
+    Returns:
+        dict: sla_seconds, boot_seconds, run_overhead_seconds, min_sample_targets, min_instances,
+            max_instances, alpha and seconds_per_target
+    """
+    with open(file_path, encoding="utf-8") as config_file:
+        config = json.load(config_file)
+    config["sla_seconds"] = float(getenv("FLEET_SLA_SECONDS", config.get("sla_seconds", 1800)))
+    config["max_instances"] = int(getenv("FLEET_MAX_INSTANCES", config.get("max_instances", 10)))
+    config.setdefault("boot_seconds", 0)
+    config.setdefault("run_overhead_seconds", 0)
+    config.setdefault("min_sample_targets", 50)
+    config.setdefault("min_instances", 1)
+    config.setdefault("alpha", 0.3)
+    costs = config.setdefault("seconds_per_target", {})
+    costs.setdefault("default", 1)
+    if not 1 <= config["min_instances"] <= config["max_instances"]:
+        raise ValueError(f"{file_path}: expected 1 <= min_instances <= max_instances")
+    if config["run_overhead_seconds"] < 0:
+        raise ValueError(f"{file_path}: run_overhead_seconds cannot be negative")
+    if config["sla_seconds"] <= config["boot_seconds"] + config["run_overhead_seconds"]:
+        raise ValueError(f"{file_path}: sla_seconds must be longer than boot_seconds and run_overhead_seconds")
+    if not 0 < config["alpha"] <= 1:
+        raise ValueError(f"{file_path}: alpha must be in ]0, 1]")
+    for profile, cost in costs.items():
+        if cost <= 0:
+            raise ValueError(f"{file_path}: seconds_per_target of {profile} must be positive")
+    return config
+
+
+# ------------------------------ SIZING ------------------------------
+class FleetSizer:
+    """Choose the number of Axiom instances for a scan.
+
+    The work of a scan is its number of targets times the node-seconds one target of
+    its profile costs, on top of a fixed overhead per axiom-scan run. The fleet is the
+    smallest one finishing that work within the SLA once booted: every extra node adds
+    its boot time to the instance-minutes, so the smallest fleet meeting the SLA is
+    also the cheapest. Both costs start at their configured values and follow the run
+    times actually recorded (exponential moving averages): runs of fewer than
+    min_sample_targets targets only correct the overhead, larger runs the cost per
+    target, so frequent single-target scans cannot inflate it.
+    Without a profile, the static ranges of data/config.json are used.
+    """
+
+    def __init__(self, ranges: list, config: dict, history_file: str = None):
+        self.ranges = ranges
+        self.config = config
+        self.history_file = history_file
+        self.history = {}  # Profile -> seconds_per_target, samples, overhead_seconds, overhead_samples
+        self.lock = threading.Lock()
+        if history_file and path.exists(history_file):
+            try:
+                with open(history_file, encoding="utf-8") as history:
+                    self.history = json.load(history)
+            except (OSError, ValueError) as e:
+                utils.axiom_log(f"Sizing history {history_file} ignored: {e}")
+
+    def from_ranges(self, count: int):
+        for low, high, instances in self.ranges:
+            if count >= low and (high is None or count <= high):
+                return instances
+        return self.ranges[-1][2]  # Above the last closed range
+
+    def seconds_per_target(self, profile: str):
+        """Node-seconds one target of a profile costs, learned or configured."""
+        learned = self.history.get(profile, {})
+        if "seconds_per_target" in learned:
+            return learned["seconds_per_target"]
+        costs = self.config["seconds_per_target"]
+        return costs.get(profile, costs["default"])
+
+    def overhead(self, profile: str):
+        """Seconds an axiom-scan run of a profile takes whatever its targets, learned or configured."""
+        return self.history.get(profile, {}).get("overhead_seconds", self.config["run_overhead_seconds"])
+
+    def instances_needed(self, count: int, profile: str = None):
+        """Number of instances to scan `count` targets of a profile within the SLA.
+
+        Args:
+            count (int): Number of targets
+            profile (str, optional): Profile of the scan. Defaults to None (static ranges).
+
+        Returns:
+            int: Number of instances, between min_instances and max_instances
+        """
+        if profile is None:
+            number = self.from_ranges(count)
+        else:
+            work = count * self.seconds_per_target(profile)
+            budget = self.config["sla_seconds"] - self.config["boot_seconds"] - self.overhead(profile)
+            number = ceil(work / budget) if work else 1
+            if number > self.config["max_instances"]:
+                utils.axiom_log(
+                    f"{count} {profile} targets need {number} instances to meet the SLA, capped at {self.config['max_instances']}"
+                )
+        number = max(self.config["min_instances"], min(number, self.config["max_instances"]))
+        utils.axiom_log(f"Axiom fleet needs {number} instance (for {count} lines of {profile or 'any profile'})")
+        return number
+
+    def record(self, profile: str, count: int, seconds: float, instances: int):
+        """Learn the costs of a profile from a successful run on a warm fleet.
+
+        Args:
+            profile (str): Profile of the run
+            count (int): Number of targets scanned
+            seconds (float): Run time of axiom-scan
+            instances (int): Nodes leased by the scan
+        """
+        if not profile or count <= 0 or seconds <= 0 or instances <= 0:
+            return
+        with self.lock:
+            per_target = self.seconds_per_target(profile)
+            overhead = self.overhead(profile)
+            alpha = self.config["alpha"]
+            entry = self.history.setdefault(profile, {"samples": 0})
+            if count < self.config["min_sample_targets"]:
+                # Mostly the fixed cost of the run, a node scans at most ceil(count / instances) targets
+                observed = max(0.0, seconds - per_target * ceil(count / instances))
+                entry["overhead_seconds"] = alpha * observed + (1 - alpha) * overhead
+                entry["overhead_samples"] = entry.get("overhead_samples", 0) + 1
+            else:
+                observed = max(0.0, seconds - overhead) * instances / count
+                entry["seconds_per_target"] = alpha * observed + (1 - alpha) * per_target
+                entry["samples"] += 1
+            self.save()
+
+    def save(self):
+        if not self.history_file:
+            return
+        try:
+            makedirs(path.dirname(self.history_file), exist_ok=True)
+            with open(f"{self.history_file}.tmp", "w", encoding="utf-8") as history:
+                json.dump(self.history, history, indent=4)
+            replace(f"{self.history_file}.tmp", self.history_file)
+        except OSError as e:
+            utils.axiom_log(f"Error saving sizing history {self.history_file}: {e}")
+
+
+sizer = FleetSizer(load_ranges(), load_sizing(), HISTORY_FILE)
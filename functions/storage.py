@@ -0,0 +1,176 @@
+# ------------------------------ PACKAGES ------------------------------
+# Standard imports
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from os import getenv, path, remove, walk
+from random import random
+from shutil import rmtree
+from time import monotonic, sleep
+
+# Third-party libraries
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import BotoCoreError, ClientError
+import boto3
+
+# Local imports
+import functions.metrics as metrics
+import functions.utils as utils
+
+
+# ------------------------------ INIT ------------------------------
+load_dotenv()
+OUTPUT_DIR = "/var/tmp/scan_output"
+S3_PREFIX = "scan_output"
+S3_UPLOAD_WORKERS = int(getenv("S3_UPLOAD_WORKERS", "4"))  # Files uploaded at once
+S3_MAX_CONCURRENCY = int(getenv("S3_MAX_CONCURRENCY", "8"))  # Parts of one file uploaded at once
+S3_MULTIPART_THRESHOLD = int(getenv("S3_MULTIPART_THRESHOLD", str(16 * 1024 * 1024)))
+S3_MULTIPART_CHUNKSIZE = int(getenv("S3_MULTIPART_CHUNKSIZE", str(16 * 1024 * 1024)))
+S3_UPLOAD_ATTEMPTS = int(getenv("S3_UPLOAD_ATTEMPTS", "5"))
+S3_RETRY_DELAY = float(getenv("S3_RETRY_DELAY", "2"))  # Seconds, doubled after every failed attempt
+S3_RETRY_MAX_DELAY = float(getenv("S3_RETRY_MAX_DELAY", "60"))
+
+
+# ------------------------------ UPLOAD ------------------------------
+class Storage:
+    """Upload scan outputs to S3 without blocking the event loop.
+
+    Uploads run on a dedicated executor: large files are sent as parallel multipart
+    uploads, every part carries a SHA-256 checksum verified by S3, and failed uploads
+    are retried with exponential backoff. A local output is deleted only once S3 has
+    confirmed the whole object.
+
+    The S3 client can be injected (e.g. a moto client in tests), otherwise it is
+    created on first use for REGION_NAME and S3_ENDPOINT_URL.
+    """
+
+    def __init__(self, bucket: str = None, client=None, workers: int = S3_UPLOAD_WORKERS):
+        self.bucket = bucket or getenv("BUCKET_NAME")
+        self.client = client
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="s3-upload")
+        self.config = TransferConfig(
+            multipart_threshold=S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+            max_concurrency=S3_MAX_CONCURRENCY,
+            use_threads=True,
+        )
+
+    def get_client(self):
+        """Reuse a single S3 client, clients are thread safe and expensive to create."""
+        if self.client is None:
+            self.client = boto3.session.Session().client(
+                "s3",
+                region_name=getenv("REGION_NAME"),
+                endpoint_url=getenv("S3_ENDPOINT_URL") or None,
+            )
+        return self.client
+
+    def put_file(self, local_path: str, key: str):
+        """Upload a file and check that S3 holds all of it, retrying with backoff (blocking).
+
+        Returns:
+            bool: True once the upload is confirmed
+        """
+        size = path.getsize(local_path)
+        client = self.get_client()
+        for attempt in range(1, S3_UPLOAD_ATTEMPTS + 1):
+            try:
+                client.upload_file(
+                    local_path,
+                    self.bucket,
+                    key,
+                    ExtraArgs={"ChecksumAlgorithm": "SHA256"},
+                    Config=self.config,
+                )
+                stored = client.head_object(Bucket=self.bucket, Key=key)["ContentLength"]
+                if stored != size:
+                    raise ValueError(f"{stored} bytes stored for {size} bytes sent")
+                return True
+            except (BotoCoreError, ClientError, S3UploadFailedError, ValueError) as e:
+                if attempt == S3_UPLOAD_ATTEMPTS:
+                    utils.axiom_log(f"Error saving {key} in S3 bucket after {attempt} attempts: {e}")
+                    return False
+                delay = min(S3_RETRY_MAX_DELAY, S3_RETRY_DELAY * 2 ** (attempt - 1))
+                delay *= 0.5 + random() / 2  # Jitter, parallel uploads do not retry together
+                utils.axiom_log(f"Error saving {key} in S3 bucket (attempt {attempt}): {e}, retrying in {delay:.1f}s")
+                sleep(delay)
+        return False
+
+    async def upload_file(self, local_path: str, key: str, delete: bool = True):
+        """Upload a file on the upload executor.
+
+        Args:
+            local_path (str): File to upload
+            key (str): Destination key in the bucket
+            delete (bool, optional): Delete the file once the upload is confirmed. Defaults to True.
+
+        Returns:
+            bool: True if the upload is confirmed
+        """
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(self.executor, self.put_file, local_path, key):
+            return False
+        if delete:
+            remove(local_path)
+        return True
+
+    async def upload_directory(self, local_dir: str, prefix: str, delete: bool = True):
+        """Upload every file of a directory (e.g. an aquatone report) under a key prefix.
+
+        Files are streamed from disk and uploaded in parallel. The directory is deleted
+        only if every file was confirmed.
+
+        Returns:
+            bool: True if every upload is confirmed
+        """
+        uploads = [
+            self.upload_file(
+                path.join(root, name),
+                f"{prefix}/{path.relpath(path.join(root, name), local_dir)}",
+                delete=False,
+            )
+            for root, dirs, files in walk(local_dir)
+            for name in files
+        ]
+        results = await asyncio.gather(*uploads)
+        if not all(results):
+            utils.axiom_log(f"{results.count(False)} files of {local_dir} not saved in S3 bucket, keeping it")
+            return False
+        if delete:
+            rmtree(local_dir)
+        return True
+
+    async def upload_output(self, name: str, delete: bool = True):
+        """Save a scan output of OUTPUT_DIR in the bucket, under the scan_output/ prefix.
+
+        Args:
+            name (str): Output name with its extension. Tools writing a directory
+                ({name} or {name} without extension) have its files stored under scan_output/{name}/
+            delete (bool, optional): Delete the local output once the upload is confirmed. Defaults to True.
+
+        Returns:
+            bool: True if the output is confirmed in the bucket
+        """
+        local_path = path.join(OUTPUT_DIR, name)
+        key = f"{S3_PREFIX}/{name}"
+        start = monotonic()
+        if path.isfile(local_path):
+            saved = await self.upload_file(local_path, key, delete)
+        elif path.isdir(local_path) or path.isdir(path.splitext(local_path)[0]):
+            local_dir = local_path if path.isdir(local_path) else path.splitext(local_path)[0]
+            saved = await self.upload_directory(local_dir, key, delete)
+        else:
+            utils.axiom_log(f"Error saving {name} in S3 bucket: no output in {OUTPUT_DIR}")
+            return False
+        metrics.upload_time.observe(
+            monotonic() - start,
+            format=path.splitext(name)[1].lstrip("."),
+            status="completed" if saved else "error",
+        )
+        if saved:
+            utils.axiom_log(f"Saving {name} in S3 bucket.")
+        return saved
+
+
+storage = Storage()
@@ -0,0 +1,218 @@
+# ------------------------------ PACKAGES ------------------------------
+# Standard imports
+from hashlib import blake2b
+from ipaddress import ip_address, ip_network
+from os import replace
+from re import fullmatch, sub
+from urllib.parse import urlsplit
+
+
+# ------------------------------ INIT ------------------------------
+HTTPS_PROFILES = {"waf_check", "ssl_check"}  # Tools expecting https:// URLs
+HOST_PROFILES = {"ip_list", "dns_list", "port_scan", "dns_check"}  # Tools expecting bare hosts/IPs
+HOSTNAME = r"(?=.{1,253}$)(\*\.)?([a-z0-9_]([a-z0-9_-]{0,61}[a-z0-9])?\.)*[a-z0-9]([a-z0-9-]{0,61}[a-z0-9])?"
+
+
+# ------------------------------ NORMALISATION ------------------------------
+def normalise(raw: str):
+    """Clean a raw input line into a target
+
+    Surrounding spaces, quotes, commas and brackets are removed (so JSON arrays laid
+    out one entry per line are accepted) and the host part is lowercased.
+
+    Returns:
+        str: The target, None for blank lines and comments
+    """
+    target = raw.strip().strip('[]",').strip()
+    if not target or target.startswith("#"):
+        return None
+    scheme, separator, rest = target.rpartition("://")
+    host, slash, tail = rest.partition("/")
+    return f"{scheme.lower()}{separator}{host.lower()}{slash}{tail}"
+
+
+def valid_host(host: str):
+    """Check that a host is a hostname, an IP address or a CIDR range."""
+    if not host:
+        return False
+    try:
+        if "/" in host:
+            ip_network(host, strict=False)
+        else:
+            ip_address(host)
+        return True
+    except ValueError:
+        return fullmatch(HOSTNAME, host) is not None
+
+
+def for_profile(target: str, profile: str):
+    """Adapt a normalised target to what the tool of a profile expects
+
+    Returns:
+        str: The target, None if it is not a valid hostname, IP, CIDR or URL
+    """
+    if "://" in target:
+        try:
+            parts = urlsplit(target)
+            host = parts.hostname
+        except ValueError:
+            return None
+        if not valid_host(host):
+            return None
+        if profile in HOST_PROFILES:
+            return host
+        if profile in HTTPS_PROFILES and parts.scheme != "https":
+            return "https://" + target.split("://", 1)[1]
+        return target
+    host = target if valid_host(target) else target.split("/", 1)[0]  # CIDR ranges keep their /
+    if host.count(":") == 1:  # host:port, IPv6 addresses have several colons
+        host = host.rsplit(":", 1)[0]
+    if not valid_host(host):
+        return None
+    if profile in HOST_PROFILES:
+        return host
+    if profile in HTTPS_PROFILES:
+        return f"https://{target}"
+    return target
+
+
+def output_target(line: str):
+    """Target starting a line of tool output (ANSI colours removed), None for blank lines."""
+    line = sub(r"\x1b\[[0-9;]*m", "", line).strip()
+    return line.split(maxsplit=1)[0] if line else None
+
+
+def host_of(value: str):
+    """Host of a target or of an output line starting with one (ANSI colours, scheme, path and port removed)."""
+    value = (output_target(value) or "").lower()
+    if "://" in value:
+        value = value.split("://", 1)[1]
+    host = value.split("/", 1)[0]
+    if host.count(":") == 1:
+        host = host.rsplit(":", 1)[0]
+    return host
+
+
+def safe_filename(filename: str):
+    """Keep only a harmless stem of an uploaded filename."""
+    stem = sub(r"[^A-Za-z0-9._-]", "_", (filename or "upload").rsplit("/", 1)[-1])
+    return stem.rsplit(".", 1)[0].strip("._") or "upload"
+
+
+# ------------------------------ INGESTION ------------------------------
+class TargetWriter:
+    """Write normalised, deduplicated targets to a file as chunks of an upload come in.
+
+    Only the current partial line and an 8 bytes digest per target already written
+    are kept in memory, the upload itself is never held as a whole.
+    """
+
+    def __init__(self, file_path: str, csv: bool = False):
+        self.file = open(file_path, "w", encoding="utf-8")
+        self.csv = csv  # Keep the first column only
+        self.seen = set()  # Digests of the targets written
+        self.count = 0
+        self.rest = b""
+
+    def feed(self, chunk: bytes):
+        lines = (self.rest + chunk).split(b"\n")
+        self.rest = lines.pop()
+        for line in lines:
+            self.add(line.decode("utf-8", errors="replace"))
+
+    def add(self, line: str):
+        if self.csv:
+            line = line.split(",", 1)[0]
+        target = normalise(line)
+        if target is None:
+            return
+        digest = blake2b(target.encode(), digest_size=8).digest()
+        if digest in self.seen:
+            return
+        self.seen.add(digest)
+        self.file.write(f"{target}\n")
+        self.count += 1
+
+    def close(self):
+        """Flush the last line and close the file.
+
+        Returns:
+            int: Number of distinct targets written
+        """
+        if self.rest:
+            self.add(self.rest.decode("utf-8", errors="replace"))
+            self.rest = b""
+        self.file.close()
+        return self.count
+
+
+# ------------------------------ PREPROCESSING ------------------------------
+def prepare(file_path: str, profile: str):
+    """Prepare an input file for a profile in a single streaming pass
+
+    Every line is normalised, adapted to the tool of the profile (scheme added or
+    removed), validated and deduplicated, then written to the prepared file which
+    replaces the input. Only an 8 bytes digest per distinct target is kept in memory.
+
+    Args:
+        file_path (str): Input file, one target per line (first column for .csv)
+        profile (str): Profile the targets are prepared for
+
+    Returns:
+        dict: count of prepared targets, invalid and duplicate lines dropped, and
+            digest of the target set (independent of the order of the lines)
+    """
+    seen = set()
+    stats = {"count": 0, "invalid": 0, "duplicates": 0}
+    csv = file_path.endswith(".csv")
+    with open(file_path, encoding="utf-8", errors="replace") as source, open(
+        f"{file_path}.prepared", "w", encoding="utf-8"
+    ) as prepared:
+        for line in source:
+            if csv:
+                line = line.split(",", 1)[0]
+            target = normalise(line)
+            if target is None:
+                continue
+            target = for_profile(target, profile)
+            if target is None:
+                stats["invalid"] += 1
+                continue
+            digest = blake2b(target.encode(), digest_size=8).digest()
+            if digest in seen:
+                stats["duplicates"] += 1
+                continue
+            seen.add(digest)
+            prepared.write(f"{target}\n")
+            stats["count"] += 1
+    replace(f"{file_path}.prepared", file_path)
+    stats["digest"] = blake2b(b"".join(sorted(seen))).hexdigest()
+    return stats
+
+
+def read_chunks(file_path: str, size: int = 1000):
+    """Yield the targets of a prepared file by lists of at most `size`."""
+    chunk = []
+    with open(file_path, encoding="utf-8") as source:
+        for line in source:
+            if line.strip():
+                chunk.append(line.strip())
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def split_file(file_path: str, size: int):
+    """Split a prepared file into shards of at most `size` targets, written to {file_path}.shard{n}.
+
+    Returns:
+        list: Number of targets of each shard
+    """
+    sizes = []
+    for index, chunk in enumerate(read_chunks(file_path, size)):
+        with open(f"{file_path}.shard{index}", "w", encoding="utf-8") as shard:
+            shard.writelines(f"{target}\n" for target in chunk)
+        sizes.append(len(chunk))
+    return sizes
@@ -2,11 +2,7 @@
 # Standard imports
 import asyncio
 import json
-import subprocess
-from csv import reader
-from datetime import datetime
 from enum import Enum
-from io import StringIO
 from json import loads, dump, load
 from os import path, getenv
 from random import choice
@@ -15,8 +11,18 @@ from secrets import token_hex
 from string import ascii_letters, digits
 
 # Third-party libraries
+from dotenv import load_dotenv
 from sqlalchemy.inspection import inspect
 
+# Local imports
+import functions.audit as audit
+import functions.logger as logger
+import functions.runner as runner
+
+
+load_dotenv()
+COMMAND_TIMEOUT = float(getenv("AXIOM_COMMAND_TIMEOUT", "600"))  # axiom-ls/power/fleet calls
+
 
 # ------------------------------ .ENV UTILS ------------------------------
 def generate_secret_key(length=32):
@@ -99,6 +105,67 @@ def load_json():
     return data["profiles"], data["formats"], data["workflows"]
 
 
+# Load the scan worker pool settings
+def load_workers_config():
+    """Read data/workers.json, the size of the scan worker pool and the concurrency limit of each profile.
+
+    Returns:
+        tuple: Number of workers, default per-profile limit and a dict of per-profile limits
+    """
+    with open("./data/workers.json", encoding="utf-8") as config_file:
+        config = load(config_file)
+    workers = int(getenv("SCAN_WORKERS", config.get("workers", 1)))
+    default_limit = config.get("default_limit", workers)
+    return workers, default_limit, config.get("profiles", {})
+
+
+# Load the coalescing settings of single-target jobs
+def load_coalesce_config():
+    """Read data/coalesce.json, which single-target jobs are merged into one scan.
+
+    Only profiles whose output has one line per target, starting with it, can be
+    split back per job.
+
+    Returns:
+        dict: window (seconds, 0 disables coalescing), max_jobs, profiles and formats
+    """
+    with open("./data/coalesce.json", encoding="utf-8") as config_file:
+        config = load(config_file)
+    config["window"] = float(getenv("COALESCE_WINDOW", config.get("window", 0)))
+    config["max_jobs"] = int(config.get("max_jobs", 50))
+    return config
+
+
+# Load the scheduling quotas
+def load_quotas_config():
+    """Read data/quotas.json, the priority threshold and the per-user quotas.
+
+    A quota set to null is not enforced. Users missing from "users" get the "default" quotas.
+
+    Returns:
+        dict: interactive_max_targets, default (concurrent_jobs, targets_per_day) and users (email -> quotas)
+    """
+    with open("./data/quotas.json", encoding="utf-8") as config_file:
+        config = load(config_file)
+    config.setdefault("interactive_max_targets", 1)
+    config.setdefault("default", {})
+    config.setdefault("users", {})
+    return config
+
+
+# Load the access log settings
+def load_access_log_config():
+    """Read data/access_log.json, the sampling rates and redacted headers of the access log.
+
+    Returns:
+        dict: default_rate, always_log_from_status, routes (route -> rate) and redact_headers
+    """
+    with open("./data/access_log.json", encoding="utf-8") as config_file:
+        config = load(config_file)
+    config["redact_headers"] = {header.lower() for header in config.get("redact_headers", [])}
+    return config
+
+
 # Create an enum from values
 def create_enum(name, values):
     return Enum(name, {value: value for value in values})
@@ -137,121 +204,113 @@ def clean_users_data(users_data):
 
 
 # ------------------------------ SCAN UTILS ------------------------------
-def save_to_bucket(input):
-    subprocess.run(
-        [f"aws s3 cp /var/tmp/scan_output/{input} s3://{bucket}/scan_output/{input}"],
-        shell=True,
-        check=False,
-    )
-    axiom_log(f"Saving {input} in S3 bucket.")
-    return
-
+def axiom_command(name: str):
+    """Full path of an Axiom command, AXIOM_PATH is the Axiom interact folder."""
+    return f"{getenv('AXIOM_PATH', '')}{name}"
 
-def add_https_to_each_line(input):
-    axiom_log("Parsing input for web request (https/http)")
-    with open(f"/var/tmp/scan_input/{input}", "r", encoding="utf-8") as file:
-        lines = file.readlines()
-    modified_lines = []
-    for line in lines:
-        line = line.strip()
-        if not line.startswith("https://"):
-            line = "https://" + line
-        modified_lines.append(line + "\n")
-    with open(f"/var/tmp/scan_input/{input}", "w", encoding="utf-8") as file:
-        file.writelines(modified_lines)
-    return
 
+async def list_instances():
+    """List the axiom_node_* instances known by Axiom
 
-def count_lines_in_txt(file: str):
-    with open(file, 'r', encoding="utf-8") as content:
-        lines = content.readlines()
-    return len(lines)
+    Returns:
+        list: (name, public IP) tuples sorted by name, the IP is None for powered off nodes
+    """
+    result = await runner.run(
+        [axiom_command("axiom-ls"), "--json", "--skip"], timeout=COMMAND_TIMEOUT
+    )
+    try:
+        data = loads(result.stdout)
+    except ValueError:
+        axiom_log(f"Error parsing axiom-ls output: {result.stderr.strip()}")
+        return []
+    instances = []
+    for reservation in data.get("Reservations", []):
+        for instance in reservation.get("Instances", []):
+            name = next(
+                (tag["Value"] for tag in instance.get("Tags", []) if tag.get("Key") == "Name"),
+                "",
+            )
+            if "axiom_node" in name:
+                instances.append((name, instance.get("PublicIpAddress")))
+    return sorted(instances)
 
 
-def count_entries_in_json(file: str):
-    with open(file, 'r', encoding="utf-8") as content:
-        data = loads(content)
-    if isinstance(data, list):
-        return len(data)
-    return 1
+async def start_instances(number: int):
+    """Power on `number` nodes and wait until they are ready
 
+    Returns:
+        list: (name, public IP) tuples of the ready nodes
+    """
+    result = await runner.run(
+        [axiom_command("axiom-power"), "on", "axiom_node_*", "-i", number],
+        timeout=COMMAND_TIMEOUT,
+    )
+    axiom_log(result.stdout)
+    if result.returncode != 0:
+        axiom_log(f"Axiom power on error: {result.stderr.strip()}")
+        if not await list_instances():
+            await init_instances()
+    return await wait_for_instances(number)
 
-def count_rows_in_csv(file: str) -> int:
-    with open(file, 'r', encoding="utf-8") as content:
-        read = reader(StringIO(content))
-    row_count = sum(1 for row in read)
-    return row_count
 
+async def node_reachable(ip: str, port: int, timeout: float = 3):
+    """Check that a node accepts TCP connections on its SSH port."""
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
 
-# Determine the number of instances based on the line count and config.json
-async def instances_needed(count: int):
-    with open("./data/config.json", encoding="utf-8") as config_file:
-        range_config = load(config_file)
-    for range_entry in range_config:
-        if range_entry["min_lines"] <= count <= range_entry["max_lines"]:
-            number = range_entry["instances"]
-    axiom_log(f"Axiom fleet initialized with {number} instance (for {count} lines):")
-    await start_instances(number)
-    return
 
+async def wait_for_instances(number: int):
+    """Poll axiom-ls until `number` nodes have a public IP and are reachable.
 
-async def start_instances(number: int):
-    axiom_path = getenv("AXIOM_PATH")
-    await asyncio.sleep(30)
-    result = subprocess.run(
-        [f"{axiom_path}axiom-power on 'axiom_node_*' -i {number}"],
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.DEVNULL,
-        check=False,
-    )
-    axiom_log(result.stdout)
-    if result.stderr:
-        await init_instances()
-
-    await asyncio.sleep(210)
-    command = (
-        f"{axiom_path}axiom-ls --json --skip | "
-        "jq -r '.Reservations[].Instances[] | "
-        'select(.Tags[]?.Value | contains("axiom_node")) | '
-        ". as $instance | "
-        "$instance.Tags[] | "
-        'select(.Key == "Name") | '
-        "[.Value, $instance.PublicIpAddress] | "
-        "@tsv'"
-    )
-    result = subprocess.run(
-        command,
-        shell=True,
-        stdout=subprocess.PIPE,
-        check=False,
-    )
-    axiom_log(result.stdout)
-    return result.stdout
+    Polling backs off from 5 to 30 seconds and stops after FLEET_BOOT_TIMEOUT seconds.
 
+    Args:
+        number (int): Number of nodes expected
 
-def stop_instances():
-    axiom_path = getenv("AXIOM_PATH")
-    result = subprocess.run(
-        [f"{axiom_path}axiom-power off 'axiom_node_*'"],
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.DEVNULL,
-        check=False,
-    )
-    axiom_log(result.stdout)
-    axiom_log("Axiom fleet stopped")
+    Returns:
+        list: (name, public IP) tuples of the ready nodes, it may be shorter than `number` on timeout
+    """
+    timeout = float(getenv("FLEET_BOOT_TIMEOUT", "300"))
+    port = int(getenv("AXIOM_SSH_PORT", "2266"))
+    deadline = asyncio.get_event_loop().time() + timeout
+    delay = 5
+    while True:
+        ready = []
+        for name, ip in await list_instances():
+            if ip and await node_reachable(ip, port):
+                ready.append((name, ip))
+        if len(ready) >= number:
+            axiom_log(f"Axiom fleet ready: {ready}")
+            return ready
+        remaining = deadline - asyncio.get_event_loop().time()
+        if remaining <= 0:
+            axiom_log(
+                f"Axiom fleet error, only {len(ready)}/{number} instances ready after {timeout:.0f}s: {ready}"
+            )
+            return ready
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, 30)
+
+
+async def stop_instances(names=None):
+    """Power off the given nodes, or the whole fleet when no name is given."""
+    for name in names or ["axiom_node_*"]:
+        result = await runner.run(
+            [axiom_command("axiom-power"), "off", name], timeout=COMMAND_TIMEOUT
+        )
+        axiom_log(result.stdout)
+    axiom_log("Axiom fleet stopped" if not names else f"Axiom nodes stopped: {names}")
     return
 
 
-def init_instances():
-    axiom_path = getenv("AXIOM_PATH")
-    result = subprocess.run(
-        [f"{axiom_path}axiom-fleet 'axiom_node_' -i 10"],
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.DEVNULL,
-        check=False,
+async def init_instances():
+    result = await runner.run(
+        [axiom_command("axiom-fleet"), "axiom_node_", "-i", 10],
+        timeout=COMMAND_TIMEOUT,
     )
     axiom_log(result.stdout)
     return
@@ -313,99 +372,24 @@ def update_cases():
 
 
 # ------------------------------ LOG UTILS ------------------------------
+# Lines are queued to the background writer of functions.logger, colours are
+# applied when reading the logs (python3 -m functions.logger api)
 def axiom_log(message):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    if isinstance(message, bytes):
-        formatted_message = message.decode("utf-8").strip()
-    else:
-        formatted_message = str(message).strip()
-        formatted_message = f"{timestamp} - {message}"
-        if "error" in message.lower():
-            formatted_message = f"\033[91m{formatted_message}\033[0m"
-        elif any(
-            keyword in message.lower()
-            for keyword in ["success", "successful", "successfully"]
-        ):
-            formatted_message = f"\033[92m{formatted_message}\033[0m"
-
-    with open("/var/log/dnsscan/axiom.log", mode="a", encoding="utf-8") as log:
-        log.write(formatted_message + "\n")
+    logger.write("axiom", message)
     return
 
 
 def api_log(message: str):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    if isinstance(message, bytes):
-        formatted_message = message.decode("utf-8").strip()
-    else:
-        formatted_message = str(message).strip()
-        formatted_message = f"{timestamp} - {message}"
-        if any(keyword in message.lower() for keyword in ["error", "failed", "fail"]):
-            formatted_message = f"\033[91m{formatted_message}\033[0m"
-        elif any(
-            keyword in message.lower()
-            for keyword in ["success", "successful", "successfully"]
-        ):
-            formatted_message = f"\033[92m{formatted_message}\033[0m"
-        if "monitoring" in message.lower():
-            formatted_message = f"\033[93m{formatted_message}\033[0m"
-        if "startup" in message.lower():
-            formatted_message = f"\n\n{formatted_message}"
-
-    with open("/var/log/dnsscan/api.log", mode="a", encoding="utf-8") as log:
-        log.write(formatted_message + "\n")
+    logger.write("api", message)
     return
 
 
 def db_log(message: str):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    if isinstance(message, bytes):
-        formatted_message = message.decode("utf-8").strip()
-    else:
-        formatted_message = str(message).strip()
-        formatted_message = f"{timestamp} - {message}"
-        if "error" in message.lower():
-            formatted_message = f"\033[91m{formatted_message}\033[0m"
-        elif any(
-            keyword in message.lower()
-            for keyword in ["success", "successful", "successfully"]
-        ):
-            formatted_message = f"\033[92m{formatted_message}\033[0m"
-        if "setup" in message.lower():
-            formatted_message = f"\n\n{formatted_message}"
-
-    with open("/var/log/dnsscan/database.log", mode="a", encoding="utf-8") as log:
-        log.write(formatted_message + "\n")
+    logger.write("database", message)
     return
 
 
-def cert_json(assets, tool, time_range):
-    axiom_path = getenv("AXIOM_PATH")
-    date = datetime.now().strftime("%Y-%m-%d")
-    command = (
-        f"{axiom_path}axiom-ls --json --skip | "
-        "jq -r '.Reservations[].Instances[] | "
-        "select(.Tags[]?.Value | contains(\"axiom_node\")) | "
-        "select(.PublicIpAddress != null) | "
-        ".PublicIpAddress'"
-    )
-    result = subprocess.run(
-        command, shell=True, capture_output=True, text=True, check=False
-    )
-    ip = result.stdout.strip().splitlines()
-
-    scan = {"assets": assets, "ip": ip, "command": tool}
-    json_file = "/var/log/dnsscan/cert.json"
-
-    if path.exists(json_file):
-        with open(json_file, "r", encoding="utf-8") as file:
-            existing_data = json.load(file)
-    else:
-        existing_data = {}
-
-    if date not in existing_data:
-        existing_data[date] = {}
-    existing_data[date][time_range] = scan
-
-    with open(json_file, "w", encoding="utf-8") as file:
-        json.dump(existing_data, file, indent=4)
+async def cert_json(assets_path, tool, start, end):
+    """Record the scanned assets (one per line in assets_path) and the IPs of the nodes used in the audit store (functions.audit)"""
+    ip = [ip for name, ip in await list_instances() if ip]
+    await audit.record_scan(assets_path, ip, tool, start, end)
@@ -0,0 +1,190 @@
+# ------------------------------ PACKAGES ------------------------------
+# Standard imports
+import asyncio
+from contextlib import nullcontext
+from os import path, remove
+from shutil import copyfile
+from uuid import uuid4
+
+# Local imports
+import functions.scan as scan
+import functions.targets as targets
+import functions.utils as utils
+
+
+# ------------------------------ INIT ------------------------------
+INPUT_DIR = "/var/tmp/scan_input"
+OUTPUT_DIR = "/var/tmp/scan_output"
+
+
+# ------------------------------ DAG ------------------------------
+def topological_order(stages: dict):
+    """Order the stages of a workflow so every stage comes after the stages it depends on.
+
+    Raises:
+        ValueError: A stage depends on an unknown stage, or the stages form a cycle
+
+    Returns:
+        list: Stage names
+    """
+    order = []
+    state = {}  # Stage -> "visiting" / "done"
+
+    def visit(name, chain):
+        if name not in stages:
+            raise ValueError(f"unknown stage {name} (needed by {chain[-1]})")
+        if state.get(name) == "done":
+            return
+        if state.get(name) == "visiting":
+            raise ValueError(f"cycle between stages {' -> '.join(chain + [name])}")
+        state[name] = "visiting"
+        for parent in stages[name][1]:
+            visit(parent, chain + [name])
+        state[name] = "done"
+        order.append(name)
+
+    for name in stages:
+        visit(name, [])
+    return order
+
+
+def stage_input(parents: list, outputs: dict, file_path: str):
+    """Write the distinct targets found by the parent stages to the input of a stage.
+
+    Parent outputs are read line by line from the local disk, never from S3.
+
+    Returns:
+        int: Number of targets written
+    """
+    writer = targets.TargetWriter(file_path)
+    for parent in parents:
+        output_path = scan.shard_output(outputs[parent], "txt")
+        if output_path is None:
+            continue
+        with open(output_path, encoding="utf-8", errors="replace") as output:
+            for line in output:
+                target = targets.output_target(line)
+                if target is not None:
+                    writer.add(target)
+    return writer.close()
+
+
+# ------------------------------ ENGINE ------------------------------
+async def run(workflow, domain, format="txt", uuid="", progress=None, slots=None):
+    """Run the stages of a workflow as a DAG on the warm fleet
+
+    Every stage starts as soon as the stages it depends on are completed and a slot
+    of its profile is free, so independent branches run in parallel, each leasing the
+    fleet like a single scan.
+    Stages other stages depend on write txt outputs kept on disk until the workflow
+    ends, the last stages write the requested format. Every output is saved in S3.
+
+    Args:
+        workflow (str): Workflow chosen
+        domain (str): Input filename
+        format (str, optional): Output type of the last stages. Default "txt".
+        uuid (str, optional): Job UUID, used in the output filenames. Default empty.
+        progress (dict, optional): Updated with the number of output lines while the stages run. Default None.
+        slots (ProfileSlots, optional): Concurrency slots of the profiles, held by each stage while it scans. Default None.
+
+    Returns:
+        dict: Stage name -> profile, status (completed, error, skipped or empty) and S3 key of its output,
+            None for an invalid workflow
+    """
+    stages = scan.workflow_stages(workflow)
+    if stages is None:
+        return None
+    order = topological_order(stages)
+    children = {name: [child for child in stages if name in stages[child][1]] for name in stages}
+    file = scan.output_filename(domain, uuid)
+    name = path.splitext(domain)[0]
+    run_id = uuid4().hex[:8]
+    results = {
+        stage: {"profile": stages[stage][0], "status": "queued", "s3_key": None} for stage in order
+    }
+    outputs = {stage: f"{OUTPUT_DIR}/{file}_{stage}" for stage in order}
+    tasks = {}
+
+    async def run_stage(stage):
+        profile, parents = stages[stage]
+        codes = [await tasks[parent] for parent in parents]
+        if any(code != 0 for code in codes):
+            utils.axiom_log(f"Workflow {workflow}: {stage} skipped, a stage it depends on failed")
+            results[stage]["status"] = "skipped"
+            return 1
+        stage_file = f"{name}_{run_id}_{stage}.txt"
+        if parents:
+            count = await asyncio.to_thread(
+                stage_input, parents, outputs, f"{INPUT_DIR}/{stage_file}"
+            )
+            if count == 0:
+                utils.axiom_log(f"Workflow {workflow}: no target found for {stage}")
+                remove(f"{INPUT_DIR}/{stage_file}")
+                results[stage]["status"] = "empty"
+                return 0
+        else:
+            await asyncio.to_thread(copyfile, f"{INPUT_DIR}/{domain}", f"{INPUT_DIR}/{stage_file}")
+        stage_format = "txt" if children[stage] else format
+        async with slots.hold(profile) if slots is not None else nullcontext():
+            results[stage]["status"] = "running"
+            code = await scan.scan(
+                input=stage_file,
+                output=path.basename(outputs[stage]),
+                profile=profile,
+                format=stage_format,
+                progress=progress,
+                keep_output=bool(children[stage]),  # Read by the next stages
+            )
+        results[stage]["status"] = "completed" if code == 0 else "error"
+        if code == 0:
+            results[stage]["s3_key"] = f"scan_output/{path.basename(outputs[stage])}.{stage_format}"
+        return code
+
+    utils.axiom_log(f"Workflow {workflow} started for {domain}: {' -> '.join(order)}")
+    for stage in order:
+        tasks[stage] = asyncio.create_task(run_stage(stage))
+    try:
+        await asyncio.gather(*tasks.values())
+    finally:
+        for task in tasks.values():
+            task.cancel()
+        for stage in order:
+            kept = scan.shard_output(outputs[stage], "txt") if children[stage] else None
+            if kept is not None:
+                remove(kept)
+        if path.exists(f"{INPUT_DIR}/{domain}"):
+            remove(f"{INPUT_DIR}/{domain}")
+    utils.axiom_log(f"Workflow {workflow} ended for {domain}: {results}")
+    return results
+
+
+async def processing(w, domain, output="", uuid="", client_ip="", progress=None, slots=None):
+    """Run a workflow for a job and notify the requester
+
+    Args:
+        w (str): Workflow chosen
+        domain (str): Input filename
+        output (str, optional): Output type of the last stages. Default empty.
+        uuid (str, optional): Job UUID, it will be used to send a response and as a str in the filename. Default empty.
+        client_ip (str, optional): Requester IP address used to send result. Default empty.
+        progress (dict, optional): Updated with the number of output lines while the stages run. Default None.
+        slots (ProfileSlots, optional): Concurrency slots of the profiles run by the stages. Default None.
+
+    Returns:
+        dict: Job status ("completed"/"error"), exit code and result of each stage
+    """
+    utils.api_log(f"Workflow {w} requested for {domain}. The uuid is {uuid} and client_ip is {client_ip}")
+    stages = await run(w, domain, output or "txt", uuid, progress, slots)
+    failed = stages is None or any(
+        stage["status"] not in ("completed", "empty") for stage in stages.values()
+    )
+    status = "error" if failed else "completed"
+    if uuid and client_ip:
+        scan.notify(status, scan.output_filename(domain, uuid), uuid, client_ip)
+    return {
+        "status": status,
+        "exit_code": 1 if failed else 0,
+        "s3_key": None,
+        "cached_keys": [],
+        "stages": stages,
+    }
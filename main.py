@@ -3,6 +3,8 @@
 import logging
 from logging.config import dictConfig
 import asyncio
+from os import getpid
+from socket import gethostname
 
 # Third-party libraries
 import uvicorn
@@ -10,10 +12,15 @@ import yaml
 from dotenv import load_dotenv
 
 # Local imports
+import endpoints.monitoring
 import endpoints.scans
+import endpoints.security
 import endpoints.users
 import documentation.doc
+import functions.audit as audit
+import functions.callbacks as callbacks
 import functions.utils as utils
+from functions.fleet import manager as fleet
 from src.app import app
 
 # Database
@@ -23,6 +30,7 @@ from postgres.database import init_db
 def init_routers(app):
     app.include_router(endpoints.scans.router)
     app.include_router(endpoints.users.router)
+    app.include_router(endpoints.monitoring.router)
     app.include_router(documentation.doc.router)
 
 # ------------------------------ MAIN ------------------------------
@@ -51,7 +59,22 @@ async def startup_event():
     utils.update_cases()  # Refresh scan options
     load_dotenv()  # Load environment variables from .env
     await init_db()  # Initialize database
+    migrated = audit.migrate_legacy()  # Move a former cert.json to the audit segments
+    if migrated:
+        utils.api_log(f"{migrated} scans migrated from cert.json to the audit store")
     init_routers(app)   # Initialize the router
+    asyncio.create_task(endpoints.security.refresh_secret())  # Keep the admin token cached
+    asyncio.create_task(endpoints.security.watch_user_changes())  # Keep the user cache in sync with other processes
     asyncio.create_task(endpoints.scans.process_queue())
     utils.api_log("Scan queue processor started")
+    asyncio.create_task(endpoints.scans.purge_results())
+    asyncio.create_task(
+        callbacks.dispatcher.run(
+            endpoints.scans.store_dead_letter,
+            endpoints.scans.CallbackStore(f"{gethostname()}:{getpid()}"),
+        )
+    )
+    utils.api_log("Callback dispatcher started")
+    asyncio.create_task(fleet.run(endpoints.scans.queue_state))
+    utils.api_log("Axiom fleet manager started")
     utils.api_log("Startup event completed. -----------------------------")
\ No newline at end of file
@@ -1,33 +1,52 @@
 # ------------------------------ PACKAGES ------------------------------
+# Standard imports
+from datetime import datetime, timedelta
+from os import getenv
+
 # Third-party libraries
-from passlib.context import CryptContext
+from sqlalchemy import and_, case, delete, func, insert, literal, not_, or_, update
+from sqlalchemy.orm import aliased
 from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
+# Local imports
+from functions.cache import TTLCache
+from functions.passwords import get_password_hash, verify_password
+
 # Database
-from postgres.models import User
+from postgres.models import (
+    CallbackFailure,
+    PendingCallback,
+    ProfileSlot,
+    ScanJob,
+    ScanResult,
+    ScanResultTarget,
+    ScanShard,
+    User,
+)
 from postgres.schemas import UserCreate, UserUpdate
 
-# -------------------------------- PASSWORD --------------------------------
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
-
-
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+CLAIM_LOCK_KEY = 0x5CA4  # Advisory lock taken by every claim of a scan job
 
+# Authenticated users, keyed by email. Every function changing a user invalidates its entry
+# here and, through a NOTIFY on USER_CHANNEL sent on commit, in every other API process.
+USER_CHANNEL = "user_changed"
+user_cache = TTLCache(
+    maxsize=int(getenv("USER_CACHE_SIZE", "1024")),
+    ttl=float(getenv("USER_CACHE_TTL", "60")),
+)
 
+# -------------------------------- PASSWORD --------------------------------
 async def change_user_password(
     db: AsyncSession, user_id: int, old_password: str, new_password: str
 ):
     db_user = await get_user(db, user_id)
-    if db_user and verify_password(old_password, db_user.hashed_password):
-        db_user.hashed_password = get_password_hash(new_password)
+    if db_user and await verify_password(old_password, db_user.hashed_password):
+        db_user.hashed_password = await get_password_hash(new_password)
+        await notify_user_changed(db, db_user.email)
         await db.commit()
         await db.refresh(db_user)
+        user_cache.invalidate(db_user.email)
         return db_user
     return None
 
@@ -35,13 +54,21 @@ async def change_user_password(
 async def reset_password(db: AsyncSession, email: str, new_password: str):
     db_user = await get_user_by_email(db, email)
     if db_user:
-        db_user.hashed_password = get_password_hash(new_password)
+        db_user.hashed_password = await get_password_hash(new_password)
+        await notify_user_changed(db, db_user.email)
         await db.commit()
         await db.refresh(db_user)
+        user_cache.invalidate(db_user.email)
         return db_user
     return None
 
 
+async def notify_user_changed(db: AsyncSession, *emails: str):
+    """Ask every API process to drop these users from its cache, once the transaction is committed."""
+    for email in set(emails):
+        await db.execute(select(func.pg_notify(USER_CHANNEL, email)))
+
+
 # ------------------------------ RETRIEVE USER ------------------------------
 async def get_user(db: AsyncSession, user_id: int):
     query = select(User).filter(User.id == user_id)
@@ -57,6 +84,16 @@ async def get_user_by_email(db: AsyncSession, email: str):
     return user
 
 
+async def get_cached_user_by_email(db: AsyncSession, email: str):
+    """Same as get_user_by_email, served from the user cache when possible."""
+    user = user_cache.get(email)
+    if user is None:
+        user = await get_user_by_email(db, email)
+        if user is not None:
+            user_cache.set(email, user)
+    return user
+
+
 async def get_users(db: AsyncSession, skip: int = 0, limit: int = 100):
     query = select(User).offset(skip).limit(limit)
     result = await db.execute(query)
@@ -70,7 +107,7 @@ async def create_user(db: AsyncSession, user: UserCreate):
         surname=user.surname,
         firstname=user.firstname,
         email=user.email,
-        hashed_password=get_password_hash(user.password),
+        hashed_password=await get_password_hash(user.password),
         disabled=False,
     )
     db.add(db_user)
@@ -85,8 +122,10 @@ async def update_user(db: AsyncSession, email: str, user: UserUpdate):
         return None
     for key, value in user.dict(exclude_unset=True).items():
         setattr(db_user, key, value)
+    await notify_user_changed(db, email, db_user.email)
     await db.commit()
     await db.refresh(db_user)
+    user_cache.invalidate(email, db_user.email)
     return db_user
 
 
@@ -94,7 +133,9 @@ async def delete_user(db: AsyncSession, email: str):
     db_user = await get_user_by_email(db, email)
     if db_user:
         await db.delete(db_user)
+        await notify_user_changed(db, email)
         await db.commit()
+    user_cache.invalidate(email)
     return db_user
 
 
@@ -102,17 +143,589 @@ async def activate_user(db: AsyncSession, email: str):
     db_user = await get_user_by_email(db, email)
     if db_user and db_user.disabled:
         db_user.disabled = False
+        await notify_user_changed(db, email)
         await db.commit()
         await db.refresh(db_user)
-        return db_user
+    user_cache.invalidate(email)
     return db_user
 
 
 async def deactivate_user(db: AsyncSession, email: str):
     db_user = await get_user_by_email(db, email)
-    if db_user and db_user.disabled:
+    if db_user and not db_user.disabled:
         db_user.disabled = True
+        await notify_user_changed(db, email)
         await db.commit()
         await db.refresh(db_user)
-        return db_user
+    user_cache.invalidate(email)
     return db_user
+
+
+# ------------------------------ SCAN JOBS ------------------------------
+async def create_scan_job(
+    db: AsyncSession,
+    profile: str,
+    input: str,
+    output: str,
+    uuid: str,
+    client_ip: str,
+    owner: str,
+    target_count: int = None,
+    priority: int = 1,
+    workflow: str = None,
+):
+    db_job = ScanJob(
+        profile=profile,
+        workflow=workflow,
+        input=input,
+        output=output,
+        uuid=uuid,
+        client_ip=client_ip,
+        owner=owner,
+        target_count=target_count,
+        priority=priority,
+        status="queued",
+        attempts=0,
+    )
+    db.add(db_job)
+    await db.commit()
+    await db.refresh(db_job)
+    return db_job
+
+
+def profile_usage(profile, now: datetime):
+    """Number of scans of a profile in progress, over every API process.
+
+    Workers holding live leases on jobs of the profile are counted, so a coalesced
+    batch (several jobs, one worker) counts as a single scan, plus the slots held by
+    workflow stages running the profile.
+    """
+    running = aliased(ScanJob)
+    workers = (
+        select(func.count(func.distinct(running.lease_owner)))
+        .where(
+            running.profile == profile,
+            running.status == "running",
+            running.lease_expires_at >= now,
+        )
+        .scalar_subquery()
+    )
+    slots = (
+        select(func.count(ProfileSlot.id))
+        .where(ProfileSlot.profile == profile, ProfileSlot.expires_at >= now)
+        .scalar_subquery()
+    )
+    return workers + slots
+
+
+def profile_limit(limits: dict, default_limit: int):
+    """Concurrency limit of the profile of a job, as a SQL expression."""
+    if not limits:
+        return literal(default_limit)
+    return case(limits, value=ScanJob.profile, else_=default_limit)
+
+
+async def lock_claims(db: AsyncSession):
+    """Serialise the claims of every API process until the end of the transaction.
+
+    Profile limits are checked against the running jobs, two processes claiming at
+    once would otherwise both see the same free slot.
+    """
+    await db.execute(select(func.pg_advisory_xact_lock(CLAIM_LOCK_KEY)))
+
+
+async def claim_scan_job(
+    db: AsyncSession,
+    owner: str,
+    lease_seconds: int,
+    max_attempts: int,
+    limits: dict = None,
+    default_limit: int = None,
+    coalesce: dict = None,
+):
+    """Lease the next runnable job to a worker.
+
+    A job is runnable when it is queued, or when it is running but its lease expired
+    (the worker holding it crashed), and its profile is under its concurrency limit.
+    Interactive jobs go before bulk ones, then the users with the fewest running jobs
+    go first (fair share), then the oldest job. Claims of every API process are
+    serialised by an advisory lock, so limits hold across processes, and rows are
+    locked with FOR UPDATE SKIP LOCKED so no two workers ever get the same job.
+
+    Args:
+        db (AsyncSession): Database session
+        owner (str): Worker identifier stored as the lease owner
+        lease_seconds (int): Lease duration, the worker must renew it before it expires
+        max_attempts (int): Jobs leased that many times are marked as failed instead of re-leased
+        limits (dict, optional): Profile -> maximum number of concurrent scans. Defaults to None.
+        default_limit (int, optional): Limit of the profiles missing from `limits`. Defaults to None (no limit).
+        coalesce (dict, optional): profiles, formats and window (seconds) of the single-target
+            jobs merged into one scan, they are held back until their window is over. Defaults to None.
+
+    Returns:
+        ScanJob: The leased job, None if there is nothing to run
+    """
+    now = datetime.now()
+    await lock_claims(db)
+    expired = and_(ScanJob.status == "running", ScanJob.lease_expires_at < now)
+    await db.execute(
+        update(ScanJob)
+        .where(expired, ScanJob.attempts >= max_attempts)
+        .values(status="error", lease_owner=None, finished_at=now)
+    )
+    owner_jobs = aliased(ScanJob)
+    owner_running = (
+        select(func.count(owner_jobs.id))
+        .where(owner_jobs.owner == ScanJob.owner, owner_jobs.status == "running")
+        .scalar_subquery()
+    )
+    query = (
+        select(ScanJob)
+        .filter(or_(ScanJob.status == "queued", expired))
+        .order_by(ScanJob.priority, owner_running, ScanJob.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+    if default_limit is not None:
+        query = query.filter(profile_usage(ScanJob.profile, now) < profile_limit(limits, default_limit))
+    if coalesce and coalesce["window"] > 0:
+        query = query.filter(
+            not_(
+                and_(
+                    ScanJob.status == "queued",
+                    coalescable(coalesce),
+                    ScanJob.created_at > now - timedelta(seconds=coalesce["window"]),
+                )
+            )
+        )
+    result = await db.execute(query)
+    db_job = result.scalars().first()
+    if db_job is None:
+        await db.commit()
+        return None
+    db_job.status = "running"
+    db_job.lease_owner = owner
+    db_job.lease_expires_at = now + timedelta(seconds=lease_seconds)
+    db_job.attempts += 1
+    db_job.started_at = now
+    await db.commit()
+    await db.refresh(db_job)
+    return db_job
+
+
+def coalescable(coalesce: dict):
+    """Condition matching the single-target jobs that can be merged into one scan."""
+    return and_(
+        ScanJob.target_count == 1,
+        ScanJob.profile.in_(coalesce["profiles"]),
+        ScanJob.output.in_(coalesce["formats"]),
+    )
+
+
+async def claim_scan_batch(
+    db: AsyncSession, db_job: ScanJob, lease_seconds: int, coalesce: dict
+):
+    """Lease the queued jobs that can be scanned together with a job already leased.
+
+    Args:
+        db (AsyncSession): Database session
+        db_job (ScanJob): Leased single-target job, the batch shares its profile, format and lease owner
+        lease_seconds (int): Lease duration
+        coalesce (dict): profiles, formats and max_jobs of the coalescing settings
+
+    Returns:
+        list: The other leased jobs, oldest first
+    """
+    now = datetime.now()
+    query = (
+        select(ScanJob)
+        .filter(
+            ScanJob.status == "queued",
+            coalescable(coalesce),
+            ScanJob.profile == db_job.profile,
+            ScanJob.output == db_job.output,
+        )
+        .order_by(ScanJob.id)
+        .limit(coalesce["max_jobs"] - 1)
+        .with_for_update(skip_locked=True)
+    )
+    result = await db.execute(query)
+    db_jobs = result.scalars().all()
+    for other in db_jobs:
+        other.status = "running"
+        other.lease_owner = db_job.lease_owner
+        other.lease_expires_at = now + timedelta(seconds=lease_seconds)
+        other.attempts += 1
+        other.started_at = now
+    await db.commit()
+    return db_jobs
+
+
+async def renew_scan_job_lease(
+    db: AsyncSession, job_id: int, owner: str, lease_seconds: int, progress: dict = None
+):
+    """Extend the lease of a running job, and the profile slots of its worker, and store its progress.
+
+    Returns:
+        bool: False if the lease was lost
+    """
+    expires_at = datetime.now() + timedelta(seconds=lease_seconds)
+    await db.execute(
+        update(ProfileSlot).where(ProfileSlot.owner == owner).values(expires_at=expires_at)
+    )
+    values = {"lease_expires_at": expires_at}
+    if progress:
+        values["progress_lines"] = progress.get("lines", 0)
+        if progress.get("targets") is not None:
+            values["target_count"] = progress["targets"]
+    result = await db.execute(
+        update(ScanJob)
+        .where(ScanJob.id == job_id, ScanJob.lease_owner == owner)
+        .values(**values)
+    )
+    await db.commit()
+    return result.rowcount == 1
+
+
+async def acquire_profile_slot(
+    db: AsyncSession, profile: str, owner: str, limit: int, lease_seconds: int
+):
+    """Take a concurrency slot of a profile for a scan run outside of a job of its own (a workflow stage).
+
+    A slot counts like a running job of the profile in claim_scan_job, it expires
+    unless renewed with the lease of the job of its worker.
+
+    Returns:
+        ProfileSlot: The slot, None if the profile is at its limit
+    """
+    now = datetime.now()
+    await lock_claims(db)
+    if (await db.execute(select(profile_usage(profile, now)))).scalar_one() >= limit:
+        await db.commit()
+        return None
+    await db.execute(delete(ProfileSlot).where(ProfileSlot.expires_at < now))
+    db_slot = ProfileSlot(profile=profile, owner=owner, expires_at=now + timedelta(seconds=lease_seconds))
+    db.add(db_slot)
+    await db.commit()
+    await db.refresh(db_slot)
+    return db_slot
+
+
+async def release_profile_slot(db: AsyncSession, slot_id: int):
+    await db.execute(delete(ProfileSlot).where(ProfileSlot.id == slot_id))
+    await db.commit()
+
+
+async def finish_scan_job(
+    db: AsyncSession,
+    job_id: int,
+    owner: str,
+    status: str,
+    exit_code: int = None,
+    s3_key: str = None,
+    cached_keys: list = None,
+    stages: dict = None,
+):
+    """Store the final status of a job, only if the worker still holds its lease."""
+    result = await db.execute(
+        update(ScanJob)
+        .where(ScanJob.id == job_id, ScanJob.lease_owner == owner)
+        .values(
+            status=status,
+            lease_owner=None,
+            finished_at=datetime.now(),
+            exit_code=exit_code,
+            s3_key=s3_key,
+            cached_keys=cached_keys or None,
+            stages=stages,
+        )
+    )
+    await db.commit()
+    return result.rowcount == 1
+
+
+async def count_scan_jobs(db: AsyncSession, status: str):
+    query = select(func.count(ScanJob.id)).filter(ScanJob.status == status)
+    result = await db.execute(query)
+    return result.scalar_one()
+
+
+async def get_scan_usage(db: AsyncSession, owner: str, since: datetime):
+    """Usage of the scan queue by a user, checked against its quotas.
+
+    Returns:
+        tuple: Number of queued or running jobs, number of targets submitted since `since`
+    """
+    active = select(func.count(ScanJob.id)).filter(
+        ScanJob.owner == owner, ScanJob.status.in_(["queued", "running"])
+    )
+    targets = select(func.coalesce(func.sum(ScanJob.target_count), 0)).filter(
+        ScanJob.owner == owner, ScanJob.created_at >= since
+    )
+    return (await db.execute(active)).scalar_one(), (await db.execute(targets)).scalar_one()
+
+
+def queue_position():
+    """Estimated position in the queue of a queued job (1 is next), None for other statuses.
+
+    Jobs of a higher priority class or older in the same class are counted ahead,
+    fair share between users may still reorder jobs of the same class.
+    """
+    ahead = aliased(ScanJob)
+    position = (
+        select(func.count(ahead.id))
+        .where(
+            ahead.status == "queued",
+            or_(
+                ahead.priority < ScanJob.priority,
+                and_(ahead.priority == ScanJob.priority, ahead.id <= ScanJob.id),
+            ),
+        )
+        .scalar_subquery()
+    )
+    return case((ScanJob.status == "queued", position), else_=None)
+
+
+async def get_scan_job(db: AsyncSession, job_id: int):
+    """Retrieve a job and its queue position.
+
+    Returns:
+        tuple: (ScanJob, position), None if the job does not exist
+    """
+    query = select(ScanJob, queue_position()).filter(ScanJob.id == job_id)
+    result = await db.execute(query)
+    return result.first()
+
+
+async def get_scan_jobs(
+    db: AsyncSession, owner: str, status: str = None, skip: int = 0, limit: int = 100
+):
+    """Retrieve the jobs of a user, most recent first, with their queue position.
+
+    Returns:
+        list: (ScanJob, position) tuples
+    """
+    query = select(ScanJob, queue_position()).filter(ScanJob.owner == owner)
+    if status:
+        query = query.filter(ScanJob.status == status)
+    query = query.order_by(ScanJob.id.desc()).offset(skip).limit(limit)
+    result = await db.execute(query)
+    return result.all()
+
+
+# ------------------------------ SCAN SHARDS ------------------------------
+async def get_scan_shards(db: AsyncSession, job_id: int):
+    query = select(ScanShard).filter(ScanShard.job_id == job_id).order_by(ScanShard.shard)
+    result = await db.execute(query)
+    return result.scalars().all()
+
+
+async def plan_scan_shards(db: AsyncSession, job_id: int, sizes: list):
+    """Store the shards of a job, keeping their status if a previous attempt planned the same shards.
+
+    Args:
+        db (AsyncSession): Database session
+        job_id (int): Job the shards belong to
+        sizes (list): Number of targets of each shard
+
+    Returns:
+        list: Shards already completed by a previous attempt
+    """
+    db_shards = await get_scan_shards(db, job_id)
+    if [db_shard.target_count for db_shard in db_shards] == sizes:
+        return [db_shard.shard for db_shard in db_shards if db_shard.status == "completed"]
+    await db.execute(delete(ScanShard).where(ScanShard.job_id == job_id))
+    db.add_all(
+        ScanShard(job_id=job_id, shard=index, target_count=size, status="queued", attempts=0)
+        for index, size in enumerate(sizes)
+    )
+    await db.commit()
+    return []
+
+
+async def update_scan_shard(
+    db: AsyncSession, job_id: int, shard: int, status: str, exit_code: int = None
+):
+    values = {"status": status}
+    if status == "running":
+        values.update(attempts=ScanShard.attempts + 1, started_at=datetime.now(), finished_at=None)
+    else:
+        values.update(exit_code=exit_code, finished_at=datetime.now())
+    await db.execute(
+        update(ScanShard)
+        .where(ScanShard.job_id == job_id, ScanShard.shard == shard)
+        .values(**values)
+    )
+    await db.commit()
+
+# ------------------------------ SCAN RESULTS ------------------------------
+async def get_cached_result(
+    db: AsyncSession, profile: str, format: str, target_hash: str, since: datetime
+):
+    """S3 key of the latest result for exactly this target set, None if there is none since `since`."""
+    query = (
+        select(ScanResult.s3_key)
+        .filter(
+            ScanResult.profile == profile,
+            ScanResult.format == format,
+            ScanResult.target_hash == target_hash,
+            ScanResult.created_at >= since,
+        )
+        .order_by(ScanResult.id.desc())
+        .limit(1)
+    )
+    result = await db.execute(query)
+    return result.scalar()
+
+
+async def get_cached_targets(
+    db: AsyncSession, profile: str, format: str, targets: list, since: datetime
+):
+    """Find which targets were scanned since `since`.
+
+    Returns:
+        dict: target -> S3 key of the latest result containing it
+    """
+    query = (
+        select(ScanResultTarget.target, ScanResult.s3_key)
+        .join(ScanResult, ScanResult.id == ScanResultTarget.result_id)
+        .filter(
+            ScanResultTarget.profile == profile,
+            ScanResultTarget.format == format,
+            ScanResultTarget.target.in_(targets),
+            ScanResultTarget.created_at >= since,
+        )
+        .order_by(ScanResultTarget.id)
+    )
+    result = await db.execute(query)
+    return {target: s3_key for target, s3_key in result.all()}
+
+
+async def create_scan_result(
+    db: AsyncSession,
+    profile: str,
+    format: str,
+    target_hash: str,
+    target_count: int,
+    s3_key: str,
+):
+    db_result = ScanResult(
+        profile=profile,
+        format=format,
+        target_hash=target_hash,
+        target_count=target_count,
+        s3_key=s3_key,
+    )
+    db.add(db_result)
+    await db.commit()
+    await db.refresh(db_result)
+    return db_result
+
+
+async def add_scan_result_targets(db: AsyncSession, db_result: ScanResult, targets: list):
+    now = datetime.now()
+    await db.execute(
+        insert(ScanResultTarget),
+        [
+            {
+                "result_id": db_result.id,
+                "profile": db_result.profile,
+                "format": db_result.format,
+                "target": target,
+                "created_at": now,
+            }
+            for target in targets
+        ],
+    )
+    await db.commit()
+
+
+async def purge_scan_results(db: AsyncSession, before: datetime):
+    """Delete the results stored before `before`, they are no longer served from the cache.
+
+    Their targets are deleted with them by the ON DELETE CASCADE of scan_result_targets.result_id.
+    """
+    result = await db.execute(delete(ScanResult).where(ScanResult.created_at < before))
+    await db.commit()
+    return result.rowcount
+
+
+# ------------------------------ CALLBACKS ------------------------------
+async def create_pending_callback(
+    db: AsyncSession, url: str, payload: dict, owner: str, lease_seconds: int
+):
+    """Store a callback until it is sent or given up, leased to the process sending it."""
+    db_callback = PendingCallback(
+        url=url,
+        payload=payload,
+        owner=owner,
+        lease_expires_at=datetime.now() + timedelta(seconds=lease_seconds),
+    )
+    db.add(db_callback)
+    await db.commit()
+    await db.refresh(db_callback)
+    return db_callback
+
+
+async def claim_pending_callbacks(db: AsyncSession, owner: str, lease_seconds: int, limit: int):
+    """Lease the callbacks of a process which stopped or lost their lease to another process.
+
+    Rows are locked with FOR UPDATE SKIP LOCKED so no two processes take over the same callback.
+
+    Returns:
+        list: The leased callbacks, oldest first
+    """
+    now = datetime.now()
+    query = (
+        select(PendingCallback)
+        .filter(PendingCallback.lease_expires_at < now)
+        .order_by(PendingCallback.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    db_callbacks = (await db.execute(query)).scalars().all()
+    for db_callback in db_callbacks:
+        db_callback.owner = owner
+        db_callback.lease_expires_at = now + timedelta(seconds=lease_seconds)
+    await db.commit()
+    return db_callbacks
+
+
+async def renew_pending_callbacks(db: AsyncSession, owner: str, lease_seconds: int):
+    """Extend the leases of every callback still to be sent by a process."""
+    await db.execute(
+        update(PendingCallback)
+        .where(PendingCallback.owner == owner)
+        .values(lease_expires_at=datetime.now() + timedelta(seconds=lease_seconds))
+    )
+    await db.commit()
+
+
+async def reschedule_pending_callback(db: AsyncSession, callback_id: int, attempt: int, due_at: datetime):
+    await db.execute(
+        update(PendingCallback)
+        .where(PendingCallback.id == callback_id)
+        .values(attempt=attempt, due_at=due_at)
+    )
+    await db.commit()
+
+
+async def delete_pending_callback(db: AsyncSession, callback_id: int):
+    await db.execute(delete(PendingCallback).where(PendingCallback.id == callback_id))
+    await db.commit()
+
+
+async def create_callback_failure(
+    db: AsyncSession, url: str, payload: dict, attempts: int, error: str
+):
+    db_failure = CallbackFailure(url=url, payload=payload, attempts=attempts, error=error)
+    db.add(db_failure)
+    await db.commit()
+    await db.refresh(db_failure)
+    return db_failure
+
+
+async def get_callback_failures(db: AsyncSession, skip: int = 0, limit: int = 100):
+    query = select(CallbackFailure).order_by(CallbackFailure.id.desc()).offset(skip).limit(limit)
+    result = await db.execute(query)
+    return result.scalars().all()
@@ -2,12 +2,14 @@
 # Standard imports
 from dotenv import load_dotenv
 from os import path, getenv
+from time import perf_counter
 
 # Third-party libraries
 from sqlmodel import SQLModel
 from sqlmodel.ext.asyncio.session import AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 
 # Local imports
@@ -25,7 +27,41 @@ load_dotenv()
 
 DATABASE_URL = getenv("DATABASE_URL")
 
-engine = create_async_engine(DATABASE_URL, echo=True, future=True)
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Connection pool recording how long checkouts wait for a free connection."""
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait = perf_counter() - start
+            pool_stats["checkouts"] += 1
+            pool_stats["wait_seconds_total"] += wait
+            pool_stats["wait_seconds_max"] = max(pool_stats["wait_seconds_max"], wait)
+
+
+def env_flag(name, default):
+    return getenv(name, default).lower() in ("1", "true", "yes")
+
+
+pool_stats = {"checkouts": 0, "wait_seconds_total": 0.0, "wait_seconds_max": 0.0}
+
+engine = create_async_engine(
+    DATABASE_URL,
+    echo=env_flag("DB_ECHO", "false"),
+    future=True,
+    poolclass=TimedQueuePool,
+    pool_size=int(getenv("DB_POOL_SIZE", "5")),
+    max_overflow=int(getenv("DB_MAX_OVERFLOW", "10")),
+    pool_timeout=float(getenv("DB_POOL_TIMEOUT", "30")),
+    pool_recycle=int(getenv("DB_POOL_RECYCLE", "1800")),
+    pool_pre_ping=env_flag("DB_POOL_PRE_PING", "true"),
+)
+
+SessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
 Base = declarative_base()
 
@@ -33,9 +69,25 @@ Base = declarative_base()
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(SQLModel.metadata.create_all)
+        await conn.run_sync(Base.metadata.create_all)  # Tables declared in postgres.models
 
 
 async def get_db() -> AsyncSession:
-    async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
-    async with async_session() as session:
+    async with SessionLocal() as session:
         yield session
+
+
+def pool_metrics():
+    """Usage of the connection pool, to size it against the number of uvicorn workers."""
+    pool = engine.pool
+    checkouts = pool_stats["checkouts"]
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+        "checkouts": checkouts,
+        "wait_seconds_total": pool_stats["wait_seconds_total"],
+        "wait_seconds_avg": pool_stats["wait_seconds_total"] / checkouts if checkouts else 0.0,
+        "wait_seconds_max": pool_stats["wait_seconds_max"],
+    }
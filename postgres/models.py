@@ -1,6 +1,9 @@
 # ------------------------------ PACKAGES ------------------------------
+# Standard imports
+from datetime import datetime
+
 # Third-party libraries
-from sqlalchemy import Boolean, Column, Integer, String
+from sqlalchemy import JSON, Boolean, Column, DateTime, ForeignKey, Index, Integer, String
 
 
 # Database
@@ -16,3 +19,102 @@ class User(Base):
     email = Column(String, unique=True, index=True)
     hashed_password = Column(String)
     disabled = Column(Boolean, default=False)
+
+
+class ScanJob(Base):
+    __tablename__ = "scan_jobs"
+    id = Column(Integer, primary_key=True, index=True)
+    profile = Column(String, index=True)  # Profile, or workflow name for workflow jobs
+    workflow = Column(String, nullable=True)  # Set for workflow jobs
+    input = Column(String)
+    output = Column(String)
+    uuid = Column(String, nullable=True)
+    client_ip = Column(String)
+    owner = Column(String, index=True)  # Email of the user who submitted the job
+    status = Column(String, default="queued", index=True)  # queued, running, completed, error
+    priority = Column(Integer, default=1)  # 0 interactive, 1 bulk, lower is scanned first
+    attempts = Column(Integer, default=0)
+    lease_owner = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True, index=True)
+    created_at = Column(DateTime, default=datetime.now)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    target_count = Column(Integer, nullable=True)
+    progress_lines = Column(Integer, default=0)  # axiom-scan output lines read so far
+    exit_code = Column(Integer, nullable=True)
+    s3_key = Column(String, nullable=True)
+    cached_keys = Column(JSON, nullable=True)  # Earlier results reused for part or all of the targets
+    stages = Column(JSON, nullable=True)  # Workflow jobs: stage -> profile, status and S3 key
+
+    __table_args__ = (Index("ix_scan_jobs_owner_status", "owner", "status"),)
+
+
+class ProfileSlot(Base):
+    __tablename__ = "profile_slots"
+    id = Column(Integer, primary_key=True, index=True)
+    profile = Column(String, index=True)  # Profile run by a workflow stage
+    owner = Column(String)  # Worker running the workflow job
+    expires_at = Column(DateTime, index=True)  # Renewed with the lease of the job
+
+
+class ScanShard(Base):
+    __tablename__ = "scan_shards"
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(Integer, ForeignKey("scan_jobs.id", ondelete="CASCADE"))
+    shard = Column(Integer)  # Position of the shard in the input, from 0
+    target_count = Column(Integer)
+    status = Column(String, default="queued")  # queued, running, completed, error
+    attempts = Column(Integer, default=0)
+    exit_code = Column(Integer, nullable=True)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (Index("ix_scan_shards_job_shard", "job_id", "shard", unique=True),)
+
+class ScanResult(Base):
+    __tablename__ = "scan_results"
+    id = Column(Integer, primary_key=True, index=True)
+    profile = Column(String)
+    format = Column(String)
+    target_hash = Column(String)  # Digest of the whole target set
+    target_count = Column(Integer)
+    s3_key = Column(String)
+    created_at = Column(DateTime, default=datetime.now, index=True)
+
+    __table_args__ = (Index("ix_scan_results_lookup", "profile", "format", "target_hash"),)
+
+
+class ScanResultTarget(Base):
+    __tablename__ = "scan_result_targets"
+    id = Column(Integer, primary_key=True)
+    result_id = Column(Integer, ForeignKey("scan_results.id", ondelete="CASCADE"), index=True)
+    profile = Column(String)
+    format = Column(String)
+    target = Column(String)
+    created_at = Column(DateTime, default=datetime.now)
+
+    __table_args__ = (
+        Index("ix_scan_result_targets_lookup", "profile", "format", "target"),
+    )
+
+
+class PendingCallback(Base):
+    __tablename__ = "pending_callbacks"
+    id = Column(Integer, primary_key=True, index=True)
+    url = Column(String)
+    payload = Column(JSON)
+    attempt = Column(Integer, default=1)  # Next attempt
+    due_at = Column(DateTime, default=datetime.now)  # Time of the next attempt
+    owner = Column(String)  # API process sending the callback
+    lease_expires_at = Column(DateTime, index=True)  # Renewed by the owner, then taken over by another process
+    created_at = Column(DateTime, default=datetime.now)
+
+
+class CallbackFailure(Base):
+    __tablename__ = "callback_failures"
+    id = Column(Integer, primary_key=True, index=True)
+    url = Column(String)
+    payload = Column(JSON)
+    attempts = Column(Integer)
+    error = Column(String)
+    created_at = Column(DateTime, default=datetime.now, index=True)
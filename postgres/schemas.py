@@ -1,5 +1,6 @@
 # ------------------------------ PACKAGES ------------------------------
 # Standard imports
+from datetime import datetime
 from pydantic import BaseModel, EmailStr
 from typing import Optional
 
@@ -50,3 +51,51 @@ class UserFilter(BaseModel):
 
 class UserChangeStatus(BaseModel):
     email: EmailStr
+
+
+class ScanJob(BaseModel):
+    id: int
+    profile: str
+    workflow: Optional[str] = None
+    input: str
+    output: str
+    status: str
+    priority: Optional[int] = None
+    queue_position: Optional[int] = None
+    attempts: int
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    target_count: Optional[int] = None
+    progress_lines: Optional[int] = None
+    exit_code: Optional[int] = None
+    s3_key: Optional[str] = None
+    cached_keys: Optional[list[str]] = None
+    stages: Optional[dict] = None
+
+    class Config:
+        orm_mode = True
+
+
+class ScanShard(BaseModel):
+    shard: int
+    target_count: int
+    status: str
+    attempts: int
+    exit_code: Optional[int] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        orm_mode = True
+
+class CallbackFailure(BaseModel):
+    id: int
+    url: str
+    payload: dict
+    attempts: int
+    error: Optional[str] = None
+    created_at: datetime
+
+    class Config:
+        orm_mode = True
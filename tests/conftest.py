@@ -0,0 +1,11 @@
+# ------------------------------ PACKAGES ------------------------------
+# Standard imports
+import sys
+import tempfile
+from os import environ, path
+
+
+# ------------------------------ INIT ------------------------------
+# Logs of the modules under test go to a temporary folder, not /var/log/dnsscan
+environ.setdefault("LOG_DIR", tempfile.mkdtemp(prefix="dnsscan-logs-"))
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
@@ -0,0 +1,167 @@
+# ------------------------------ PACKAGES ------------------------------
+# Standard imports
+import asyncio
+import hashlib
+import hmac
+import json
+from datetime import datetime
+
+# Third-party libraries
+import httpx
+import pytest
+
+# Local imports
+import functions.callbacks as callbacks
+from functions.callbacks import CallbackDispatcher
+
+
+# ------------------------------ INIT ------------------------------
+URL = "http://client.test/callback"
+PAYLOAD = {"status": "completed", "file": "2024-01-01_scan", "uuid": "1234"}
+
+
+@pytest.fixture(autouse=True)
+def no_delay(monkeypatch):
+    monkeypatch.setattr(callbacks, "CALLBACK_RETRY_DELAY", 0)
+    monkeypatch.setattr(callbacks, "CALLBACK_ATTEMPTS", 3)
+
+
+async def dispatch(statuses: list, secret: str = None):
+    """Send one callback to a stand-in client answering `statuses` in turn (the last one repeats).
+
+    Returns:
+        tuple: Requests received, dead letters (url, payload, attempts, error)
+    """
+    requests, dead_letters = [], []
+    settled = asyncio.Event()
+
+    def handler(request):
+        requests.append(request)
+        status = statuses[min(len(requests), len(statuses)) - 1]
+        if 200 <= status < 300:
+            settled.set()
+        return httpx.Response(status)
+
+    async def dead_letter(*args):
+        dead_letters.append(args)
+        settled.set()
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    dispatcher = CallbackDispatcher(2, client=client, secret=secret)
+    runner = asyncio.create_task(dispatcher.run(dead_letter))
+    dispatcher.send(URL, PAYLOAD)
+    try:
+        await asyncio.wait_for(settled.wait(), timeout=5)
+    finally:
+        runner.cancel()
+        await client.aclose()
+    return requests, dead_letters
+
+
+class MemoryStore:
+    """Stand-in for the pending_callbacks table, `orphans` were left by a stopped process."""
+
+    def __init__(self, orphans=()):
+        self.pending = {}
+        self.orphans = list(orphans)
+
+    async def add(self, url, payload, lease_seconds):
+        callback_id = len(self.pending) + len(self.orphans) + 1
+        self.pending[callback_id] = (url, payload, 1)
+        return callback_id
+
+    async def claim(self, lease_seconds, limit):
+        claimed, self.orphans = self.orphans[:limit], self.orphans[limit:]
+        for callback_id, url, payload, attempt, due_at in claimed:
+            self.pending[callback_id] = (url, payload, attempt)
+        return claimed
+
+    async def renew(self, lease_seconds):
+        pass
+
+    async def reschedule(self, callback_id, attempt, due_at):
+        url, payload, previous = self.pending[callback_id]
+        self.pending[callback_id] = (url, payload, attempt)
+
+    async def remove(self, callback_id):
+        del self.pending[callback_id]
+
+
+async def dispatch_stored(store: MemoryStore, sent: int, statuses: list):
+    """Send callbacks through a store until `sent` requests were received, answered with `statuses` in turn."""
+    requests = []
+    settled = asyncio.Event()
+
+    def handler(request):
+        requests.append(request)
+        if len(requests) >= sent:
+            settled.set()
+        return httpx.Response(statuses[min(len(requests), len(statuses)) - 1])
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    dispatcher = CallbackDispatcher(2, client=client)
+    runner = asyncio.create_task(dispatcher.run(store=store))
+    await asyncio.sleep(0)
+    dispatcher.send(URL, PAYLOAD)
+    try:
+        await asyncio.wait_for(settled.wait(), timeout=5)
+        await asyncio.sleep(0.1)  # Let the worker update the store
+    finally:
+        runner.cancel()
+        await client.aclose()
+    return requests
+
+
+# ------------------------------ TESTS ------------------------------
+def test_failed_callback_is_retried_until_accepted():
+    requests, dead_letters = asyncio.run(dispatch([503, 502, 200]))
+
+    assert len(requests) == 3
+    assert json.loads(requests[-1].content) == PAYLOAD
+    assert dead_letters == []
+
+
+def test_callback_is_given_up_after_the_last_attempt():
+    requests, dead_letters = asyncio.run(dispatch([500]))
+
+    assert len(requests) == 3
+    assert dead_letters == [(URL, PAYLOAD, 3, "HTTP 500")]
+
+
+def test_refused_callback_is_not_retried():
+    requests, dead_letters = asyncio.run(dispatch([404]))
+
+    assert len(requests) == 1
+    assert dead_letters == [(URL, PAYLOAD, 1, "HTTP 404")]
+
+
+def test_callback_is_signed_with_the_secret():
+    requests, dead_letters = asyncio.run(dispatch([200], secret="s3cret"))
+
+    request = requests[0]
+    timestamp = request.headers["X-Signature-Timestamp"]
+    expected = hmac.new(b"s3cret", timestamp.encode() + b"." + request.content, hashlib.sha256)
+    assert request.headers["X-Signature"] == f"sha256={expected.hexdigest()}"
+
+
+def test_callback_is_not_signed_without_secret():
+    requests, dead_letters = asyncio.run(dispatch([200]))
+
+    assert "X-Signature" not in requests[0].headers
+
+
+def test_stored_callback_is_removed_once_sent():
+    store = MemoryStore()
+    requests = asyncio.run(dispatch_stored(store, 2, [503, 200]))
+
+    assert len(requests) == 2
+    assert store.pending == {}
+
+
+def test_callback_of_a_stopped_process_is_taken_over():
+    orphan = {"status": "error", "file": "2024-01-01_other", "uuid": "5678"}
+    store = MemoryStore([(7, URL, orphan, 2, datetime.now())])
+    requests = asyncio.run(dispatch_stored(store, 2, [200]))
+
+    assert sorted(json.loads(request.content)["uuid"] for request in requests) == ["1234", "5678"]
+    assert store.pending == {}
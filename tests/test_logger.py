@@ -0,0 +1,53 @@
+# ------------------------------ PACKAGES ------------------------------
+# Standard imports
+from glob import glob
+
+# Third-party libraries
+import pytest
+
+# Local imports
+import functions.logger as logger
+from functions.logger import LogFile
+
+
+# ------------------------------ INIT ------------------------------
+@pytest.fixture(autouse=True)
+def log_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(logger, "LOG_DIR", str(tmp_path))
+    monkeypatch.setattr(logger, "LOG_MAX_BYTES", 100)
+    return tmp_path
+
+
+def write(log_file: LogFile, line: str):
+    """Write a line like LogWriter.write does."""
+    log_file.write(line)
+    log_file.file.flush()
+    if log_file.should_rotate():
+        log_file.rotate()
+
+
+# ------------------------------ TESTS ------------------------------
+def test_process_writes_to_the_file_rotated_by_another(log_dir):
+    first, second = LogFile("api"), LogFile("api")  # Two API processes
+    write(first, "a" * 100 + "\n")
+    write(second, "second\n")
+
+    assert (log_dir / "api.log").read_text() == "second\n"
+    assert len(glob(f"{log_dir}/api.log.[0-9]*")) == 1
+
+
+def test_log_is_rotated_once_by_two_processes(log_dir):
+    first, second = LogFile("api"), LogFile("api")
+    first.write("a" * 60 + "\n")
+    second.write("b" * 60 + "\n")
+    for log_file in (first, second):
+        log_file.file.flush()
+    assert first.should_rotate() and second.should_rotate()  # Both reach the limit together
+    first.rotate()
+    second.rotate()
+    write(second, "second\n")
+
+    backups = glob(f"{log_dir}/api.log.[0-9]*")
+    assert len(backups) == 1
+    assert len(open(backups[0]).read()) == 122
+    assert (log_dir / "api.log").read_text() == "second\n"
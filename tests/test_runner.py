@@ -0,0 +1,60 @@
+# ------------------------------ PACKAGES ------------------------------
+# Standard imports
+import asyncio
+from time import monotonic
+
+# Third-party libraries
+import pytest
+
+# Local imports
+import functions.runner as runner
+
+
+# ------------------------------ INIT ------------------------------
+@pytest.fixture(autouse=True)
+def short_drain(monkeypatch):
+    monkeypatch.setattr(runner, "STREAM_DRAIN_TIMEOUT", 1)
+
+
+async def timed(coroutine):
+    start = monotonic()
+    result = await coroutine
+    return result, monotonic() - start
+
+
+# ------------------------------ TESTS ------------------------------
+def test_timeout_kills_the_children_holding_the_pipes():
+    result, seconds = asyncio.run(timed(runner.run(["bash", "-c", "sleep 30 | cat"], timeout=1)))
+
+    assert result.timed_out
+    assert seconds < 5
+
+
+def test_children_left_behind_do_not_block_the_result():
+    result, seconds = asyncio.run(timed(runner.run(["bash", "-c", "echo start; (sleep 30 &); echo end"])))
+
+    assert result.returncode == 0
+    assert result.stdout == "start\nend\n"
+    assert seconds < 5
+
+
+def test_cancellation_kills_the_children():
+    async def cancel():
+        task = asyncio.create_task(runner.run(["bash", "-c", "sleep 30 | cat"]))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    result, seconds = asyncio.run(timed(cancel()))
+
+    assert seconds < 5
+
+
+def test_long_line_is_read_in_full():
+    lines = []
+    script = f"import sys; sys.stdout.write('a' * {3 * runner.STREAM_LIMIT} + '\\nend\\n')"
+    result = asyncio.run(runner.run(["python3", "-c", script], on_stdout=lines.append, max_output=0))
+
+    assert "".join(lines[:-1]) == "a" * 3 * runner.STREAM_LIMIT
+    assert lines[-1] == "end"
@@ -0,0 +1,100 @@
+# ------------------------------ PACKAGES ------------------------------
+# Standard imports
+import asyncio
+from os import path
+
+# Third-party libraries
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from moto import mock_aws
+import boto3
+import pytest
+
+# Local imports
+import functions.storage as storage_module
+from functions.storage import Storage
+
+
+# ------------------------------ INIT ------------------------------
+BUCKET = "scan-test"
+PART_SIZE = 5 * 1024 * 1024  # Smallest part S3 accepts
+
+
+class FlakyClient:
+    """S3 client failing the first `failures` uploads, then behaving like the wrapped client."""
+
+    def __init__(self, client, failures: int):
+        self.client = client
+        self.failures = failures
+        self.uploads = 0
+
+    def upload_file(self, *args, **kwargs):
+        self.uploads += 1
+        if self.failures:
+            self.failures -= 1
+            raise S3UploadFailedError("connection reset by peer")
+        return self.client.upload_file(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+@pytest.fixture
+def s3(monkeypatch, tmp_path):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setattr(storage_module, "OUTPUT_DIR", str(tmp_path))
+    monkeypatch.setattr(storage_module, "S3_RETRY_DELAY", 0)
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def write_output(directory, name: str, size: int):
+    file_path = path.join(directory, name)
+    with open(file_path, "wb") as output:
+        output.write(b"x" * size)
+    return file_path
+
+
+# ------------------------------ TESTS ------------------------------
+def test_large_output_is_sent_as_multipart_upload(s3, tmp_path):
+    storage = Storage(BUCKET, client=s3)
+    storage.config = TransferConfig(multipart_threshold=PART_SIZE, multipart_chunksize=PART_SIZE)
+    file_path = write_output(tmp_path, "scan.txt", 2 * PART_SIZE + 1024)
+
+    assert asyncio.run(storage.upload_output("scan.txt"))
+
+    head = s3.head_object(Bucket=BUCKET, Key="scan_output/scan.txt")
+    assert head["ContentLength"] == 2 * PART_SIZE + 1024
+    assert head["ETag"].strip('"').endswith("-3")  # One ETag per part
+    assert not path.exists(file_path)  # Deleted once confirmed
+
+
+def test_failed_upload_is_retried(s3, tmp_path):
+    client = FlakyClient(s3, failures=2)
+    storage = Storage(BUCKET, client=client)
+    file_path = write_output(tmp_path, "scan.json", 1024)
+
+    assert asyncio.run(storage.upload_output("scan.json"))
+
+    assert client.uploads == 3
+    assert s3.head_object(Bucket=BUCKET, Key="scan_output/scan.json")["ContentLength"] == 1024
+    assert not path.exists(file_path)
+
+
+def test_output_is_kept_when_the_upload_fails(s3, tmp_path):
+    client = FlakyClient(s3, failures=storage_module.S3_UPLOAD_ATTEMPTS)
+    storage = Storage(BUCKET, client=client)
+    file_path = write_output(tmp_path, "scan.txt", 1024)
+
+    assert not asyncio.run(storage.upload_output("scan.txt"))
+
+    assert client.uploads == storage_module.S3_UPLOAD_ATTEMPTS
+    assert path.exists(file_path)
+    assert s3.list_objects_v2(Bucket=BUCKET).get("KeyCount", 0) == 0
+
+
+def test_missing_output_is_not_reported_as_saved(s3):
+    assert not asyncio.run(Storage(BUCKET, client=s3).upload_output("missing.txt"))